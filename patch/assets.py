@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+cache_dir = os.path.join('..', 'prnet', 'cache')
+
+
+class AssetRegistry:
+    """
+    Loads the static prnet assets (uv masks, face indices, triangles) once and shares them between all modules.
+    Text and png sources are converted to .npy files in cache_dir on first use, later runs memory map them. Every
+    device gets a single tensor copy of each asset, the returned tensors are shared and must not be modified in place.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.arrays = {}
+        self.tensors = {}
+
+    def get_cache_path(self, path):
+        name = os.path.normpath(path).replace(os.sep, '_').lstrip('._')
+        return os.path.join(self.cache_dir, os.path.splitext(name)[0] + '.npy')
+
+    def get_array(self, path):
+        if path in self.arrays:
+            return self.arrays[path]
+        cache_path = self.get_cache_path(path)
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+            if path.endswith('.png'):
+                array = np.asarray(Image.open(path).convert('L'))[np.newaxis]
+            else:
+                array = np.loadtxt(path).astype(np.int64)
+            np.save(cache_path, array)
+        self.arrays[path] = np.load(cache_path, mmap_mode='r')
+        return self.arrays[path]
+
+    def get(self, path, device='cpu'):
+        """
+        Returns the asset as a tensor on device, images are [1, h, w] float tensors in [0, 1] (as
+        transforms.ToTensor) and text files int64 tensors.
+        """
+        key = (path, str(device))
+        if key not in self.tensors:
+            tensor = torch.from_numpy(np.array(self.get_array(path)))
+            if tensor.dtype == torch.uint8:
+                tensor = tensor.type(torch.float32).div(255)
+            self.tensors[key] = tensor.to(device)
+        return self.tensors[key]
+
+
+registry = AssetRegistry(cache_dir)
+
+
+def get_asset(path, device='cpu'):
+    return registry.get(path, device)
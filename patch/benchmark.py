@@ -0,0 +1,234 @@
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+import kornia
+from kornia.utils import create_meshgrid
+
+import utils
+import render
+from config import patch_config_types
+from nn_modules import LandmarkExtractor, FaceXZooProjector
+from assets import AssetRegistry, cache_dir
+from gallery_index import build_gallery_index, evaluate_index
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def time_fn(fn, repeats=5):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def get_image_batch(config, batch_size):
+    _, train_loader = utils.get_train_loaders(config)
+    img_batch = next(iter(train_loader))[0]
+    repeats = -(-batch_size // img_batch.shape[0])
+    return img_batch.repeat(repeats, 1, 1, 1)[:batch_size].to(device)
+
+
+@torch.no_grad()
+def benchmark_render(config, batch_sizes=(1, 4, 8, 16, 32), rasterizers=('dense', 'tiled', 'zbuffer'), repeats=5):
+    face_landmark_detector = utils.get_landmark_detector(config, device)
+    location_extractor = LandmarkExtractor(device, face_landmark_detector, config.img_size).to(device)
+    fxz_projector = FaceXZooProjector(device, config.img_size, config.patch_size).to(device)
+    img_batch = get_image_batch(config, max(batch_sizes))
+
+    preds = location_extractor(img_batch)
+    pos, vertices = fxz_projector.get_vertices(img_batch, preds)
+    texture_img = kornia.geometry.remap(img_batch, map_x=pos[:, 0], map_y=pos[:, 1], mode='nearest')
+    colors = fxz_projector.prn.get_colors_from_texture(texture_img, fxz_projector.face_ind)
+
+    h, w = config.img_size
+    for rasterizer in rasterizers:
+        for batch_size in batch_sizes:
+            try:
+                seconds = time_fn(lambda: render.render_cy_pt(vertices[:batch_size], colors[:batch_size],
+                                                              fxz_projector.triangles, batch_size, h, w, device,
+                                                              rasterizer=rasterizer), repeats)
+            except RuntimeError as e:
+                print(f'{rasterizer:>8} | batch {batch_size:>3} | failed: {e}', flush=True)
+                torch.cuda.empty_cache()
+                continue
+            print(f'{rasterizer:>8} | batch {batch_size:>3} | {seconds * 1000:9.1f} ms/batch | '
+                  f'{batch_size / seconds:8.1f} img/s', flush=True)
+
+
+def align_patch_reference(fxz_projector, adv_patch, landmarks):
+    """
+    The original per sample implementation of FaceXZooProjector.align_patch, kept for equivalence checks.
+    """
+    batch_size = landmarks.shape[0]
+    src_pts = fxz_projector.patch_bbox.repeat(batch_size, 1, 1)
+
+    landmarks = landmarks.type(torch.float32)
+    max_side_dist = torch.maximum(landmarks[:, 33, 0]-landmarks[:, 2, 0], landmarks[:, 14, 0]-landmarks[:, 33, 0])
+    max_side_dist = torch.where(max_side_dist < fxz_projector.mask_half_width, fxz_projector.mask_half_width, max_side_dist)
+
+    left_top = torch.stack((landmarks[:, 33, 0]-max_side_dist, landmarks[:, 62, 1]-fxz_projector.mask_half_height), dim=-1)
+    right_top = torch.stack((landmarks[:, 33, 0]+max_side_dist, landmarks[:, 62, 1]-fxz_projector.mask_half_height), dim=-1)
+    left_bottom = torch.stack((landmarks[:, 33, 0]-max_side_dist,  landmarks[:, 62, 1]+fxz_projector.mask_half_height), dim=-1)
+    right_bottom = torch.stack((landmarks[:, 33, 0]+max_side_dist, landmarks[:, 62, 1]+fxz_projector.mask_half_height), dim=-1)
+    dst_pts = torch.stack([left_top, right_top, left_bottom, right_bottom], dim=1)
+
+    tform = kornia.geometry.homography.find_homography_dlt(src_pts, dst_pts)
+    cropped_image = kornia.geometry.warp_perspective(adv_patch, tform, dsize=(fxz_projector.img_size_width, fxz_projector.img_size_height), mode='nearest')
+
+    grid = create_meshgrid(112, 112, False, device=fxz_projector.device).repeat(batch_size, 1, 1, 1)
+
+    for i in range(batch_size):
+        bbox_info = fxz_projector.get_bbox(cropped_image[i:i+1])
+        left_top = bbox_info[:, 0]
+        right_top = bbox_info[:, 1]
+        x_center = (right_top[:, 0] - left_top[:, 0]) / 2
+        target_y = torch.mean(torch.stack([landmarks[i, 0, 1], landmarks[i, 0, 1]]))
+        max_y_left = torch.clamp_min(-(target_y - left_top[:, 1]), 0)
+        start_idx_left = min(int(left_top[0, 0].item()), fxz_projector.img_size_width)
+        end_idx_left = min(int(start_idx_left + x_center), fxz_projector.img_size_width)
+        offset = torch.zeros_like(grid[i, :, start_idx_left:end_idx_left, 1])
+        dropoff = 0.97
+        for j in range(offset.shape[1]):
+            offset[:, j] = (max_y_left - ((j*max_y_left)/offset.shape[1])) * dropoff
+
+        grid[i, :, start_idx_left:end_idx_left, 1] = grid[i, :, start_idx_left:end_idx_left, 1] + offset
+
+        target_y = torch.mean(torch.stack([landmarks[i, 16, 1], landmarks[i, 16, 1]]))
+        max_y_right = torch.clamp_min(-(target_y - right_top[:, 1]), 0)
+        end_idx_right = min(int(right_top[0, 0].item()), fxz_projector.img_size_width) + 1
+        start_idx_right = min(int(end_idx_right - x_center), fxz_projector.img_size_width)
+        offset = torch.zeros_like(grid[i, :, start_idx_right:end_idx_right, 1])
+        for idx, col in enumerate(reversed(range(offset.shape[1]))):
+            offset[:, col] = (max_y_right - ((idx*max_y_right)/offset.shape[1])) * dropoff
+        grid[i, :, start_idx_right:end_idx_right, 1] = grid[i, :, start_idx_right:end_idx_right, 1] + offset
+
+    cropped_image = kornia.geometry.transform.remap(cropped_image, map_x=grid[..., 0], map_y=grid[..., 1], mode='nearest')
+    return cropped_image
+
+
+@torch.no_grad()
+def benchmark_align_patch(config, batch_sizes=(1, 4, 8, 16, 32), repeats=20):
+    face_landmark_detector = utils.get_landmark_detector(config, device)
+    location_extractor = LandmarkExtractor(device, face_landmark_detector, config.img_size).to(device)
+    fxz_projector = FaceXZooProjector(device, config.img_size, config.patch_size).to(device)
+    img_batch = get_image_batch(config, max(batch_sizes))
+    landmarks = location_extractor(img_batch)
+    adv_patch = utils.get_patch(config).detach().to(device)
+
+    for batch_size in batch_sizes:
+        patch_batch = adv_patch.expand(batch_size, -1, -1, -1)
+        batch_landmarks = landmarks[:batch_size]
+        reference = align_patch_reference(fxz_projector, patch_batch, batch_landmarks)
+        aligned = fxz_projector.align_patch(patch_batch, batch_landmarks)
+        reference_seconds = time_fn(lambda: align_patch_reference(fxz_projector, patch_batch, batch_landmarks), repeats)
+        seconds = time_fn(lambda: fxz_projector.align_patch(patch_batch, batch_landmarks), repeats)
+        mismatch = ((aligned - reference).abs().amax(dim=1) > 0).type(torch.float32).mean().item()
+        print(f'batch {batch_size:>3} | reference {reference_seconds * 1000:8.2f} ms | aligned {seconds * 1000:8.2f} ms '
+              f'({reference_seconds / seconds:5.1f}x) | mismatched pixels {mismatch:.2%}', flush=True)
+
+
+def load_assets_from_source():
+    """
+    Asset loading as done before the registry, new_uv.png was decoded by five modules and the mesh text files by two.
+    """
+    for _ in range(5):
+        transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L')).to(device)
+    transforms.ToTensor()(Image.open('../prnet/uv_face_mask.png').convert('L')).to(device)
+    for _ in range(2):
+        np.loadtxt('../prnet/face_ind.txt')
+        np.loadtxt('../prnet/triangles.txt')
+
+
+def load_assets_from_registry():
+    registry = AssetRegistry(cache_dir)
+    for _ in range(5):
+        registry.get('../prnet/new_uv.png', device)
+    registry.get('../prnet/uv_face_mask.png', device)
+    for _ in range(2):
+        registry.get('../prnet/face_ind.txt', device)
+        registry.get('../prnet/triangles.txt', device)
+
+
+def benchmark_assets(batch_size=32, repeats=20):
+    print(f'startup | source {time_fn(load_assets_from_source, 1) * 1000:8.2f} ms | '
+          f'registry {time_fn(load_assets_from_registry, 1) * 1000:8.2f} ms', flush=True)
+
+    pos = torch.rand(batch_size, 3, 256 * 256, device=device)
+    face_ind = np.loadtxt('../prnet/face_ind.txt').astype(np.int32)
+    face_ind_t = AssetRegistry(cache_dir).get('../prnet/face_ind.txt', device)
+    print(f'get_vertices | numpy index {time_fn(lambda: pos[..., face_ind], repeats) * 1000:8.3f} ms | '
+          f'device index {time_fn(lambda: pos[..., face_ind_t], repeats) * 1000:8.3f} ms', flush=True)
+
+
+def benchmark_frozen_models(config, batch_size=8, repeats=5):
+    """
+    Time and peak memory of a training step (projection, embedders, backward to the patch) with the embedders as
+    loaded before and with frozen embedders.
+    """
+    face_landmark_detector = utils.get_landmark_detector(config, device)
+    location_extractor = LandmarkExtractor(device, face_landmark_detector, config.img_size).to(device)
+    fxz_projector = FaceXZooProjector(device, config.img_size, config.patch_size, rasterizer=config.rasterizer).to(device)
+    img_batch = get_image_batch(config, batch_size)
+    preds = location_extractor(img_batch)
+    adv_patch = utils.get_patch(config).to(device)
+
+    for frozen in (False, True):
+        # built outside of the model registry, so deleting them frees the models (and the gradients of the unfrozen ones)
+        embedders = {embedder_name: utils.build_embedder(embedder_name, device, frozen)
+                     for embedder_name in config.train_embedder_names}
+
+        def train_step():
+            img_batch_applied = fxz_projector(img_batch, preds, adv_patch, do_aug=config.mask_aug)
+            loss = torch.stack([emb_model(img_batch_applied).mean() for emb_model in embedders.values()]).sum()
+            loss.backward()
+
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        seconds = time_fn(train_step, repeats)
+        peak_memory = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else float('nan')
+        print(f'frozen {str(frozen):>5} | {seconds * 1000:9.1f} ms/step | peak memory {peak_memory:9.1f} MB', flush=True)
+        del embedders
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+@torch.no_grad()
+def benchmark_gallery_index(num_identities=(200, 10000, 100000), num_probes=2048, emb_size=512, k=5,
+                            index_types=(('exact', 'fp16'), ('exact', 'int8'), ('ivf', 'fp32'), ('ivfpq', 'fp32'))):
+    """
+    Recall@k against the exact fp32 search and throughput of every index on a synthetic gallery, the probes are noisy
+    copies of random gallery identities.
+    """
+    generator = torch.Generator().manual_seed(0)
+    for size in num_identities:
+        gallery = torch.randn(size, emb_size, generator=generator).to(device)
+        probes = gallery[torch.randint(size, (num_probes,), generator=generator).to(device)]
+        probes = probes + 0.8 * torch.randn(probes.shape, generator=generator).to(device)
+        exact_index = build_gallery_index(gallery, device=device)
+        for index_type, dtype in index_types:
+            index = build_gallery_index(gallery, index_type, dtype, device)
+            evaluate_index(index, exact_index, probes[:8], k)  # warm up
+            recall, throughput, exact_throughput = evaluate_index(index, exact_index, probes, k)
+            print(f'gallery {size:>7} | {index_type:>5} {dtype} | recall@{k} {recall:.4f} | {throughput:10.0f} probes/s '
+                  f'(exact fp32 {exact_throughput:10.0f})', flush=True)
+
+
+def main():
+    config = patch_config_types['base']()
+    benchmark_render(config)
+    benchmark_align_patch(config)
+    benchmark_assets()
+    benchmark_frozen_models(config)
+    benchmark_gallery_index()
+
+
+if __name__ == '__main__':
+    main()
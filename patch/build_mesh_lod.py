@@ -0,0 +1,87 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+import utils
+from benchmark import time_fn
+from config import patch_config_types
+from nn_modules import LandmarkExtractor, FaceXZooProjector
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+lod_dir = os.path.join('..', 'prnet', 'lod')
+
+
+def build_lod(face_ind, stride, resolution=256):
+    """
+    Simplifies the PRNet mesh by keeping every stride-th vertex of the UV grid and triangulating the coarse grid.
+    Returns the kept face_ind values (in face_ind order) and the triangles indexing into them.
+    """
+    in_face = np.zeros(resolution * resolution, dtype=bool)
+    in_face[face_ind] = True
+    on_grid = np.zeros((resolution, resolution), dtype=bool)
+    on_grid[::stride, ::stride] = True
+    lod_face_ind = face_ind[on_grid.reshape(-1)[face_ind]]
+
+    vertex_ids = np.full(resolution * resolution, -1, dtype=np.int64)
+    vertex_ids[lod_face_ind] = np.arange(lod_face_ind.shape[0])
+    vs, us = np.meshgrid(np.arange(0, resolution - stride, stride), np.arange(0, resolution - stride, stride),
+                         indexing='ij')
+    top_left = (vs * resolution + us).reshape(-1)
+    a, b = vertex_ids[top_left], vertex_ids[top_left + stride]
+    c, d = vertex_ids[top_left + stride * resolution], vertex_ids[top_left + stride * resolution + stride]
+
+    # full cells are split into two triangles, cells missing a single corner keep the remaining triangle
+    triangles = np.concatenate([
+        np.stack([a, b, c], axis=1)[(a >= 0) & (b >= 0) & (c >= 0)],
+        np.stack([b, d, c], axis=1)[(b >= 0) & (c >= 0) & (d >= 0)],
+        np.stack([a, d, c], axis=1)[(a >= 0) & (b < 0) & (c >= 0) & (d >= 0)],
+        np.stack([a, b, d], axis=1)[(a >= 0) & (b >= 0) & (c < 0) & (d >= 0)],
+    ])
+    return lod_face_ind, triangles
+
+
+def save_lods(lods=(2, 4)):
+    Path(lod_dir).mkdir(parents=True, exist_ok=True)
+    face_ind = np.loadtxt('../prnet/face_ind.txt').astype(np.int64)
+    for lod in lods:
+        lod_face_ind, triangles = build_lod(face_ind, lod)
+        np.savetxt(os.path.join(lod_dir, 'face_ind_' + str(lod) + '.txt'), lod_face_ind, fmt='%d')
+        np.savetxt(os.path.join(lod_dir, 'triangles_' + str(lod) + '.txt'), triangles, fmt='%d')
+        print(f'lod {lod}: {lod_face_ind.shape[0]} vertices, {triangles.shape[0]} triangles', flush=True)
+
+
+@torch.no_grad()
+def report_pixel_difference(config, lods=(2, 4)):
+    face_landmark_detector = utils.get_landmark_detector(config, device)
+    location_extractor = LandmarkExtractor(device, face_landmark_detector, config.img_size).to(device)
+    img_batch = next(iter(utils.get_train_loaders(config)[0]))[0].to(device)
+    preds = location_extractor(img_batch)
+    mask_t = utils.load_mask(config, config.blue_mask_path, device)
+
+    results = {}
+    for lod in (1,) + tuple(lods):
+        fxz_projector = FaceXZooProjector(device, config.img_size, config.patch_size, rasterizer=config.rasterizer,
+                                          mesh_lod=lod).to(device)
+        project = lambda: fxz_projector(img_batch, preds, mask_t[:, :3], uv_mask_src=mask_t[:, 3], is_3d=True)
+        results[lod] = project(), time_fn(project), fxz_projector.triangles.shape[1]
+
+    full_mesh, full_seconds, full_triangles = results.pop(1)
+    print(f'lod 1: {full_triangles} triangles, {full_seconds * 1000:.1f} ms/batch', flush=True)
+    for lod, (applied, seconds, n_triangles) in results.items():
+        diff = (applied - full_mesh).abs()
+        print(f'lod {lod}: {n_triangles} triangles, {seconds * 1000:.1f} ms/batch ({full_seconds / seconds:.2f}x), '
+              f'mean abs pixel diff {diff.mean().item():.5f}, '
+              f'changed pixels {(diff.amax(dim=1) > 1 / 255).float().mean().item():.2%}', flush=True)
+
+
+def main():
+    save_lods()
+    config = patch_config_types['base']()
+    report_pixel_difference(config)
+
+
+if __name__ == '__main__':
+    main()
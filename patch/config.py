@@ -96,6 +96,15 @@ class BaseConfiguration:
                                                                                         min_lr=self.sc_min_lr,
                                                                                         mode='min')
 
+        # Rendering options
+        self.rasterizer = 'tiled'  # dense, tiled, zbuffer
+        self.cull_mask_region = True  # only render the triangles touching the mask and the ones that may occlude them
+        self.mesh_lod = 1  # 1 (full mesh), 2, 4 (see build_mesh_lod.py), auto. Coarser meshes only sample every lod-th patch texel
+        self.render_memory_budget = 2 * 1024 ** 3  # bytes, larger frames are rendered in row bands. None to disable
+        self.precision = 'fp32'  # fp32, fp16, bf16 (autocast of the landmarks, projection and embedders)
+        self.geometry_cache_dir = os.path.join('..', 'geometry_cache', self.train_dataset_name)  # None to disable
+        self.geometry_cache_max_images = None  # the shared cache grows up to this many images, None for no limit
+
         # Landmark detection options
         self.landmark_detector_type = 'mobilefacenet'  # face_alignment, mobilefacenet
 
@@ -104,6 +113,8 @@ class BaseConfiguration:
         self.test_embedder_names = ['resnet100_arcface', 'resnet50_arcface', 'resnet34_arcface', 'resnet18_arcface',
                                     'resnet100_cosface', 'resnet50_cosface', 'resnet34_cosface', 'resnet18_cosface',
                                     'resnet100_magface']
+        self.embedder_memory_budget = 2 * 1024 ** 3  # bytes, larger batches run through each embedder in chunks. None to disable
+        self.gallery_dtype = 'fp32'  # fp32, fp16, int8 storage of the target embeddings (train loss and test scores)
 
         # Loss options
         self.dist_loss_type = 'cossim'
@@ -118,6 +129,13 @@ class BaseConfiguration:
         self.white_mask_path = os.path.join(self.masks_path, 'white.png')
         self.face1_mask_path = os.path.join(self.masks_path, 'face1.png')
         self.face3_mask_path = os.path.join(self.masks_path, 'face3.png')
+        self.gallery_index_type = 'exact'  # exact, ivf, ivfpq (test search, recall@k against exact search is reported)
+        self.gallery_top_k = 5
+        self.gallery_dense_max_identities = 4096  # larger test galleries only keep the top-k and true identity scores
+        self.ap_num_bins = None  # None for exact average precision, else bins of the streaming histogram approximation (no preds csv)
+        self.verification_far_targets = [1e-3, 1e-4]  # TAR@FAR of the 1:1 verification, empty to skip it
+        self.verification_pairs_path = None  # csv of image_a, image_b[, is_genuine] pairs, None for all the pairs
+        self.verification_block_size = 4096
 
         self.update_current_dir()
 
@@ -162,6 +180,7 @@ class TargetedAttack(BaseConfiguration):
         self.num_of_train_images = 10
         self.train_batch_size = 1
         self.test_batch_size = 4
+        self.train_identities_batch = 8  # identities trained together by train_multiple.py
         self.test_img_dir = {self.train_dataset_name: self.train_img_dir}
 
     def update_test_celeb_lab(self):
@@ -0,0 +1,58 @@
+import torch
+import torch.nn as nn
+import torch.fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+
+def freeze_model(model, fold_bn=True):
+    """
+    Puts an auxiliary network in inference mode for the patch optimization, the model is switched to eval, its
+    parameters stop requiring gradients (autograd only tracks the path from the patch) and, with fold_bn, every
+    BatchNorm directly following a (transposed) convolution or linear layer is folded into its weights.
+    """
+    model.eval()
+    if fold_bn:
+        model = fold_batch_norm(model)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def fold_batch_norm(model):
+    """
+    Folds BatchNorm layers into the preceding convolution or linear layer of the traced model, models that can not be
+    traced are returned unchanged.
+    """
+    try:
+        traced = torch.fx.symbolic_trace(model)
+    except Exception:
+        return model
+    modules = dict(traced.named_modules())
+    folded = 0
+    for node in list(traced.graph.nodes):
+        if node.op != 'call_module' or not isinstance(modules[node.target], (nn.BatchNorm1d, nn.BatchNorm2d)):
+            continue
+        prev = node.args[0]
+        if not isinstance(prev, torch.fx.Node) or prev.op != 'call_module' or len(prev.users) > 1:
+            continue
+        layer, bn = modules[prev.target], modules[node.target]
+        if bn.running_mean is None:
+            continue
+        if isinstance(layer, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            fused = fuse_conv_bn_eval(layer, bn)
+        elif isinstance(layer, nn.ConvTranspose2d) and isinstance(bn, nn.BatchNorm2d):
+            fused = fuse_conv_bn_eval(layer, bn, transpose=True)
+        elif isinstance(layer, nn.Linear) and isinstance(bn, nn.BatchNorm1d):
+            fused = fuse_linear_bn_eval(layer, bn)
+        else:
+            continue
+        parent_name, _, name = prev.target.rpartition('.')
+        setattr(traced.get_submodule(parent_name), name, fused)
+        node.replace_all_uses_with(prev)
+        traced.graph.erase_node(node)
+        folded += 1
+    if folded == 0:
+        return model
+    traced.delete_all_unused_submodules()
+    traced.recompile()
+    return traced
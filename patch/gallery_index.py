@@ -0,0 +1,192 @@
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+storage_dtypes = {'fp32': torch.float32, 'fp16': torch.float16, 'int8': torch.int8}
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    """
+    Spherical k-means of the L2 normalized rows of x, returns the [k, d] normalized centroids and the [n] assignments.
+    """
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:k].to(x.device)].clone()
+    for _ in range(iterations):
+        assignments = (x @ centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        empty = sums.norm(dim=1) == 0
+        centroids = torch.where(empty[:, None], centroids, F.normalize(sums, dim=-1))
+    return centroids, (x @ centroids.T).argmax(dim=1)
+
+
+class GalleryIndex:
+    """
+    Exact cosine search over the L2 normalized target embeddings of the gallery identities, stored as fp32, fp16 or
+    int8 (per vector scale). Probes are scored against [block_size] gallery blocks and the top-k is merged block by
+    block, so galleries of any size are searched without materializing the [probes, identities] score matrix.
+    """
+    def __init__(self, vectors, dtype='fp32', block_size=65536, device='cpu'):
+        vectors = F.normalize(vectors.reshape(vectors.shape[0], -1).type(torch.float32), dim=-1).to(device)
+        self.dtype = dtype
+        self.block_size = block_size
+        self.device = device
+        if dtype == 'int8':
+            self.scales = vectors.abs().amax(dim=1).clamp(min=1e-12) / 127
+            self.vectors = torch.round(vectors / self.scales[:, None]).type(torch.int8)
+        else:
+            self.scales = None
+            self.vectors = vectors.type(storage_dtypes[dtype])
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def get_vectors(self, ids=None):
+        """
+        The [n, d] fp32 (dequantized) gallery vectors of ids, all of them if ids is None.
+        """
+        vectors = self.vectors if ids is None else self.vectors[ids]
+        vectors = vectors.type(torch.float32)
+        if self.scales is not None:
+            vectors = vectors * (self.scales if ids is None else self.scales[ids])[:, None]
+        return vectors
+
+    def score_block(self, probes, start, end):
+        block = self.vectors[start:end]
+        if self.dtype == 'fp16' and probes.device.type == 'cuda':
+            return (probes.type(torch.float16) @ block.T).type(torch.float32)
+        scores = probes @ block.type(torch.float32).T
+        if self.scales is not None:
+            scores = scores * self.scales[start:end]
+        return scores
+
+    def score(self, probes):
+        """
+        The full [probes, identities] cosine score matrix.
+        """
+        probes = F.normalize(probes.type(torch.float32).to(self.device), dim=-1)
+        return torch.cat([self.score_block(probes, start, start + self.block_size)
+                          for start in range(0, len(self), self.block_size)], dim=1)
+
+    def score_pairs(self, probes, ids):
+        """
+        The cosine score of every probe with the gallery vector of its id.
+        """
+        probes = F.normalize(probes.type(torch.float32).to(self.device), dim=-1)
+        return (probes * self.get_vectors(ids)).sum(dim=1)
+
+    @torch.no_grad()
+    def search(self, probes, k=5):
+        """
+        Returns the top-k (scores, ids) of every probe.
+        """
+        probes = F.normalize(probes.type(torch.float32).to(self.device), dim=-1)
+        top_scores = torch.empty(len(probes), 0, device=self.device)
+        top_ids = torch.empty(len(probes), 0, dtype=torch.int64, device=self.device)
+        for start in range(0, len(self), self.block_size):
+            scores = self.score_block(probes, start, start + self.block_size)
+            ids = torch.arange(start, start + scores.shape[1], device=self.device).expand_as(scores)
+            top_scores, order = torch.cat([top_scores, scores], dim=1).topk(min(k, top_scores.shape[1] + scores.shape[1]), dim=1)
+            top_ids = torch.gather(torch.cat([top_ids, ids], dim=1), 1, order)
+        return top_scores, top_ids
+
+
+class IVFIndex(GalleryIndex):
+    """
+    Approximate search, the gallery is split into num_lists k-means clusters (inverted lists) and every probe is only
+    scored against the members of its num_probe closest clusters. Scoring runs list by list, one matmul between each
+    list and the probes that selected it. With pq_subvectors the candidates are scored by product quantization
+    (asymmetric distances to pq_subvectors codebooks of 256 centroids) instead of the stored vectors.
+    """
+    def __init__(self, vectors, dtype='fp32', num_lists=None, num_probe=None, pq_subvectors=None, device='cpu'):
+        super(IVFIndex, self).__init__(vectors, dtype=dtype, device=device)
+        vectors = self.get_vectors()
+        self.num_lists = num_lists or max(1, int(math.sqrt(len(self))))
+        self.num_probe = num_probe or max(1, self.num_lists // 8)
+        self.centroids, assignments = kmeans(vectors, self.num_lists)
+        # the members of every list are contiguous in list_ids, starting at list_offsets
+        self.list_ids = torch.argsort(assignments, stable=True)
+        self.list_sizes = torch.bincount(assignments, minlength=self.num_lists).tolist()
+        self.list_offsets = [0] + torch.cumsum(torch.tensor(self.list_sizes), dim=0).tolist()[:-1]
+
+        self.pq_subvectors = pq_subvectors
+        if pq_subvectors is not None:
+            sub_vectors = vectors.reshape(len(self), pq_subvectors, -1)
+            codebooks, codes = [], []
+            for m in range(pq_subvectors):
+                codebook, code = self.train_codebook(sub_vectors[:, m], min(256, len(self)))
+                codebooks.append(codebook)
+                codes.append(code)
+            self.codebooks = torch.stack(codebooks)
+            self.codes = torch.stack(codes, dim=1).type(torch.uint8)
+
+    @staticmethod
+    def train_codebook(x, k, iterations=20, seed=0):
+        generator = torch.Generator(device='cpu').manual_seed(seed)
+        codebook = x[torch.randperm(len(x), generator=generator)[:k].to(x.device)].clone()
+        for _ in range(iterations):
+            code = torch.cdist(x, codebook).argmin(dim=1)
+            sums = torch.zeros_like(codebook).index_add_(0, code, x)
+            counts = torch.bincount(code, minlength=k)[:, None]
+            codebook = torch.where(counts > 0, sums / counts.clamp(min=1), codebook)
+        return codebook, torch.cdist(x, codebook).argmin(dim=1)
+
+    def score_list(self, probes, list_index):
+        """
+        Scores of the probes against the members of a list, and the member ids.
+        """
+        offset = self.list_offsets[list_index]
+        ids = self.list_ids[offset:offset + self.list_sizes[list_index]]
+        if self.pq_subvectors is None:
+            return probes @ self.get_vectors(ids).T, ids
+        # [probes, subvectors, 256] lookup tables of the sub vector dot products
+        tables = torch.einsum('qmd,mkd->qmk', probes.reshape(len(probes), self.pq_subvectors, -1), self.codebooks)
+        subvectors = torch.arange(self.pq_subvectors, device=probes.device)
+        return tables[:, subvectors[None, :], self.codes[ids].type(torch.int64)].sum(dim=-1), ids
+
+    @torch.no_grad()
+    def search(self, probes, k=5):
+        probes = F.normalize(probes.type(torch.float32).to(self.device), dim=-1)
+        closest_lists = (probes @ self.centroids.T).topk(self.num_probe, dim=1).indices
+        longest = max(self.list_sizes)
+        scores = torch.full((len(probes), self.num_probe, longest), -float('inf'), device=self.device)
+        ids = torch.full((len(probes), self.num_probe, longest), -1, dtype=torch.int64, device=self.device)
+        for list_index in torch.unique(closest_lists).tolist():
+            probe_index, slot = torch.nonzero(closest_lists == list_index, as_tuple=True)
+            list_scores, list_ids = self.score_list(probes[probe_index], list_index)
+            scores[probe_index, slot, :len(list_ids)] = list_scores
+            ids[probe_index, slot, :len(list_ids)] = list_ids
+        scores, ids = scores.reshape(len(probes), -1), ids.reshape(len(probes), -1)
+        top_scores, order = scores.topk(min(k, scores.shape[1]), dim=1)
+        return top_scores, torch.gather(ids, 1, order)
+
+
+def build_gallery_index(vectors, index_type='exact', dtype='fp32', device='cpu'):
+    if index_type == 'exact':
+        return GalleryIndex(vectors, dtype=dtype, device=device)
+    elif index_type == 'ivf':
+        return IVFIndex(vectors, dtype=dtype, device=device)
+    elif index_type == 'ivfpq':
+        return IVFIndex(vectors, dtype=dtype, pq_subvectors=8, device=device)
+    raise ValueError('Unknown gallery index type ' + index_type)
+
+
+def evaluate_index(index, exact_index, probes, k=5):
+    """
+    Returns the recall@k of index (the fraction of probes whose exact nearest identity is in its top-k) and the query
+    throughput (probes per second) of index and exact_index.
+    """
+    def timed_search(searched_index):
+        if probes.device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = searched_index.search(probes, k)
+        if probes.device.type == 'cuda':
+            torch.cuda.synchronize()
+        return result, len(probes) / (time.perf_counter() - start)
+
+    (_, ids), throughput = timed_search(index)
+    (_, exact_ids), exact_throughput = timed_search(exact_index)
+    recall = (ids == exact_ids[:, :1]).any(dim=1).type(torch.float32).mean().item()
+    return recall, throughput, exact_throughput
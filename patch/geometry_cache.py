@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def get_weights_hash(modules, extra=''):
+    """
+    Hash of the weights of the modules producing the cached geometry (landmark detector, PRNet) and of extra (the
+    preprocessing of the images), any change in either invalidates the cache.
+    """
+    sha = hashlib.sha1(extra.encode())
+    for module in modules:
+        for name, tensor in module.state_dict().items():
+            sha.update(name.encode())
+            sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class GeometryCache:
+    """
+    On disk cache of the landmarks and PRNet position maps of the train images, keyed by the content hash of the image
+    file. Arrays are stored as .npy memory maps with one row per image so cached batches are read without
+    deserialization. The vertices and the nearest neighbour remap coordinates are slices of the position map and are
+    not stored separately.
+    The cache directory is tied to a weights hash, opening it with a different hash clears it.
+    The directory is shared between runs on different image sets (e.g. the identities of train_multiple.py), so the
+    arrays grow when new images do not fit, up to max_capacity images (None for no limit) after which new images are
+    not cached.
+    """
+    def __init__(self, cache_dir, weights_hash, capacity, max_capacity=None):
+        self.cache_dir = cache_dir
+        self.weights_hash = weights_hash
+        self.capacity = capacity
+        self.max_capacity = max_capacity
+        self.hits = 0
+        self.misses = 0
+        self.file_hashes = {}
+
+        meta = self.read_meta()
+        if meta is not None and meta['weights_hash'] != weights_hash:
+            self.clear()
+            meta = None
+        if meta is None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            meta = {'weights_hash': weights_hash, 'rows': {},
+                    'capacity': capacity if max_capacity is None else min(capacity, max_capacity)}
+        self.rows = meta['rows']
+        self.capacity = meta['capacity']
+        self.landmarks = self.open_array('landmarks')
+        self.pos = self.open_array('pos')
+
+    def read_meta(self):
+        meta_path = os.path.join(self.cache_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    def write_meta(self):
+        meta = {'weights_hash': self.weights_hash, 'capacity': self.capacity, 'rows': self.rows}
+        with open(os.path.join(self.cache_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def open_array(self, name, dtype=None, shape=None):
+        path = os.path.join(self.cache_dir, name + '.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r+')
+        if dtype is None:
+            return None
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(self.capacity,) + tuple(shape))
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def grow(self, capacity):
+        """
+        Copies the cached rows into arrays of capacity rows.
+        """
+        for name in ('landmarks', 'pos'):
+            old = getattr(self, name)
+            path = os.path.join(self.cache_dir, name + '.npy')
+            new = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=old.dtype, shape=(capacity,) + old.shape[1:])
+            new[:len(self.rows)] = old[:len(self.rows)]
+            new.flush()
+            del old, new
+            setattr(self, name, None)
+            os.replace(path + '.tmp', path)
+            setattr(self, name, np.load(path, mmap_mode='r+'))
+        self.capacity = capacity
+
+    def get_keys(self, img_names):
+        for img_name in img_names:
+            if img_name not in self.file_hashes:
+                self.file_hashes[img_name] = get_file_hash(img_name)
+        return [self.file_hashes[img_name] for img_name in img_names]
+
+    def get(self, img_names, device):
+        """
+        Returns the cached (landmarks, pos) of the batch, or None if any of the images is missing.
+        """
+        rows = [self.rows.get(key) for key in self.get_keys(img_names)]
+        if None in rows:
+            self.misses += len(rows)
+            return None
+        self.hits += len(rows)
+        landmarks = torch.from_numpy(self.landmarks[rows]).to(device)
+        pos = torch.from_numpy(self.pos[rows]).to(device)
+        return landmarks, pos
+
+    def put(self, img_names, landmarks, pos):
+        if self.landmarks is None:
+            self.landmarks = self.open_array('landmarks', landmarks.cpu().numpy().dtype, landmarks.shape[1:])
+            self.pos = self.open_array('pos', np.float32, pos.shape[1:])
+        keys = self.get_keys(img_names)
+        new_rows = len(set(key for key in keys if key not in self.rows))
+        if len(self.rows) + new_rows > self.capacity and (self.max_capacity is None or self.capacity < self.max_capacity):
+            capacity = max(2 * self.capacity, len(self.rows) + new_rows)
+            self.grow(capacity if self.max_capacity is None else min(capacity, self.max_capacity))
+        dropped = 0
+        for key, img_landmarks, img_pos in zip(keys, landmarks, pos):
+            if key in self.rows:
+                continue
+            if len(self.rows) == self.capacity:
+                dropped += 1
+                continue
+            row = len(self.rows)
+            self.landmarks[row] = img_landmarks.cpu().numpy()
+            self.pos[row] = img_pos.detach().cpu().numpy()
+            self.rows[key] = row
+        self.landmarks.flush()
+        self.pos.flush()
+        self.write_meta()
+        if dropped > 0:
+            print(f'Warning: geometry cache {self.cache_dir} is full ({self.capacity} images), '
+                  f'{dropped} images of the batch are not cached', flush=True)
+
+    @torch.no_grad()
+    def fill(self, loader, location_extractor, fxz_projector, device):
+        for img_batch, img_names, _ in loader:
+            if all(key in self.rows for key in self.get_keys(img_names)):
+                continue
+            img_batch = img_batch.to(device)
+            landmarks = location_extractor(img_batch)
+            pos = fxz_projector.prn.process(img_batch, landmarks)
+            self.put(img_names, landmarks, pos)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return f'GeometryCache({len(self)}/{self.capacity} images, {self.hits} hits, {self.misses} misses)'
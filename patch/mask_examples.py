@@ -12,7 +12,9 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 face_landmark_detector = utils.get_landmark_detector(cfg, device)
 location_extractor = LandmarkExtractor(device, face_landmark_detector, cfg.img_size).to(device)
-fxz_projector = FaceXZooProjector(device, cfg.img_size, cfg.patch_size).to(device)
+fxz_projector = FaceXZooProjector(device, cfg.img_size, cfg.patch_size, rasterizer=cfg.rasterizer,
+                                  cull_mask_region=cfg.cull_mask_region, mesh_lod=cfg.mesh_lod,
+                                  memory_budget=cfg.render_memory_budget).to(device)
 img_t = transforms.ToTensor()(Image.open('image_path')).unsqueeze(0).to(device)
 person_id = 'ID1'
 Path(os.path.join('..', 'outputs', person_id)).mkdir(parents=True, exist_ok=True)
@@ -24,5 +26,6 @@ for mask_path, is_3d, save_name in [('final_patch.png', False, 'adv'),
                                     ('face3.png', True, 'female')]:
     mask_t = utils.load_mask(cfg, os.path.join('../data/masks', mask_path), device)
     uv_mask = mask_t[:, 3] if mask_t.shape[1] == 4 else None
-    applied = utils.apply_mask(location_extractor, fxz_projector, img_t, mask_t[:, :3], uv_mask, is_3d=is_3d)
+    applied = utils.apply_mask(location_extractor, fxz_projector, img_t, mask_t[:, :3], uv_mask, is_3d=is_3d,
+                               mask_key=mask_path if is_3d else None)
     transforms.ToPILImage()(applied[0].cpu()).save(os.path.join('..', 'outputs', person_id, save_name + person_id + '.png'))
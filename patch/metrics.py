@@ -0,0 +1,319 @@
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+from gallery_index import GalleryIndex, build_gallery_index, evaluate_index
+
+
+def get_one_hot(labels, num_classes):
+    return F.one_hot(labels.to(torch.int64), num_classes).type(torch.bool)
+
+
+def get_threshold_counts(y_true, scores):
+    """
+    Sorts every column of the [n, classes] scores once (descending) and returns the cumulative true and false positive
+    counts, with a mask of the last row of every group of tied scores (the rows where a threshold ends).
+    """
+    sorted_scores, order = torch.sort(scores, dim=0, descending=True)
+    sorted_true = torch.gather(y_true.type(torch.float64), 0, order)
+    tp = torch.cumsum(sorted_true, dim=0)
+    fp = torch.cumsum(1 - sorted_true, dim=0)
+    is_last = torch.ones_like(sorted_true, dtype=torch.bool)
+    is_last[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+    return tp, fp, is_last
+
+
+def get_average_precision(tp, fp, is_last):
+    """
+    Step wise average precision (as sklearn.metrics.average_precision_score) of the cumulative counts at the thresholds
+    marked by is_last, nan for classes without positives.
+    """
+    tp_at_thresholds = torch.where(is_last, tp, torch.zeros_like(tp))
+    previous_tp = torch.cat([torch.zeros_like(tp[:1]), torch.cummax(tp_at_thresholds, dim=0).values[:-1]])
+    recall_steps = torch.where(is_last, tp - previous_tp, torch.zeros_like(tp))
+    precision = tp / (tp + fp).clamp(min=1)
+    positives = tp[-1]
+    return (recall_steps * precision).sum(dim=0) / torch.where(positives > 0, positives, torch.full_like(positives, float('nan')))
+
+
+def average_precision(y_true, scores):
+    """
+    Per class average precision of [n, classes] one hot labels and scores.
+    """
+    return get_average_precision(*get_threshold_counts(y_true, scores))
+
+
+def precision_recall_curve(y_true, scores):
+    """
+    Precision and recall at every distinct threshold of a single column of labels and scores.
+    """
+    tp, fp, is_last = get_threshold_counts(y_true.reshape(-1, 1), scores.reshape(-1, 1))
+    tp, fp = tp[is_last], fp[is_last]
+    return tp / (tp + fp), tp / tp[-1].clamp(min=1)
+
+
+def get_average_precision_summary(y_true, scores):
+    """
+    Returns the per class, micro (all the (probe, class) pairs pooled) and macro (mean over the classes with positives)
+    average precision.
+    """
+    per_class = average_precision(y_true, scores)
+    micro = average_precision(y_true.reshape(-1, 1), scores.reshape(-1, 1))[0]
+    return per_class, micro, torch.nanmean(per_class)
+
+
+def get_sparse_threshold_counts(classes, scores, y_true):
+    """
+    Cumulative true and false positive counts of a flat list of (class, score, is positive) entries, grouped by class
+    and sorted by decreasing score within every class, with the mask of the thresholds (see get_threshold_counts).
+    The counts restart at every class, the returned previous_tp is the true positive count before each class.
+    """
+    order = torch.argsort(scores, descending=True, stable=True)
+    order = order[torch.argsort(classes[order], stable=True)]
+    classes, scores, y_true = classes[order], scores[order], y_true[order].type(torch.float64)
+    tp = torch.cumsum(y_true, dim=0)
+    fp = torch.cumsum(1 - y_true, dim=0)
+    is_last = torch.ones_like(y_true, dtype=torch.bool)
+    is_last[:-1] = (classes[:-1] != classes[1:]) | (scores[:-1] != scores[1:])
+    is_first = torch.ones_like(is_last)
+    is_first[1:] = classes[1:] != classes[:-1]
+    # counts of the previous classes, carried forward from the first entry of every class
+    start = torch.cummax(torch.where(is_first, torch.arange(len(classes), device=classes.device), 0), dim=0).values
+    tp_before = (tp - y_true)[start]
+    fp_before = (fp - (1 - y_true))[start]
+    return classes, tp, fp, tp_before, fp_before, is_last
+
+
+def sparse_average_precision(classes, scores, y_true, num_classes):
+    """
+    Per class average precision from only the retained (class, score, is positive) entries, e.g. the top-k of every
+    probe and its true class score. Scores missing from the entries are taken to be lower than all the retained ones.
+    """
+    classes, tp, fp, tp_before, fp_before, is_last = get_sparse_threshold_counts(classes, scores, y_true)
+    # tp is non decreasing over the whole list, so its running max at the thresholds is the count at the previous one
+    tp_at_thresholds = torch.where(is_last, tp, torch.zeros_like(tp))
+    previous_tp = torch.cat([torch.zeros_like(tp[:1]), torch.cummax(tp_at_thresholds, dim=0).values[:-1]])
+    recall_steps = torch.where(is_last, tp - previous_tp, torch.zeros_like(tp))
+    class_tp, class_fp = tp - tp_before, fp - fp_before
+    precision = class_tp / (class_tp + class_fp).clamp(min=1)
+    weighted = torch.zeros(num_classes, dtype=torch.float64, device=tp.device).index_add_(0, classes, recall_steps * precision)
+    positives = torch.zeros(num_classes, dtype=torch.float64, device=tp.device).index_add_(0, classes, recall_steps)
+    return weighted / torch.where(positives > 0, positives, torch.full_like(positives, float('nan')))
+
+
+class StreamingAveragePrecision:
+    """
+    Histogram approximation of the average precision for galleries too large to keep and sort, the scores are counted
+    into bins over [min_score, max_score] per batch. Ties within a bin are treated as a single threshold, so the result
+    converges to the exact average precision as the bins get finer.
+    A single histogram of all the (probe, class) scores with num_bins bins gives the micro average precision and the
+    PR curve, per class counts with the coarser class_bins give the per class (and macro) average precision. The counts
+    are int32 cpu tensors, 8 * (num_bins + num_classes * class_bins) bytes.
+    """
+    def __init__(self, num_classes, num_bins=1000, class_bins=64, min_score=-1., max_score=1.):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.class_bins = class_bins
+        self.min_score = min_score
+        self.max_score = max_score
+        self.positives = torch.zeros(num_bins, dtype=torch.int32)
+        self.negatives = torch.zeros(num_bins, dtype=torch.int32)
+        self.class_positives = torch.zeros(num_classes * class_bins, dtype=torch.int32)
+        self.class_negatives = torch.zeros(num_classes * class_bins, dtype=torch.int32)
+
+    def get_bins(self, scores, num_bins):
+        bins = ((scores - self.min_score) / (self.max_score - self.min_score) * num_bins).type(torch.int64)
+        # highest scores first, so the cumulative sums run over decreasing thresholds
+        return num_bins - 1 - bins.clamp(0, num_bins - 1)
+
+    @torch.no_grad()
+    def update(self, y_true, scores):
+        bins = self.get_bins(scores, self.num_bins).reshape(-1)
+        y_true = y_true.reshape(-1)
+        self.positives += torch.bincount(bins[y_true], minlength=self.num_bins).cpu().type(torch.int32)
+        self.negatives += torch.bincount(bins[~y_true], minlength=self.num_bins).cpu().type(torch.int32)
+
+        classes = torch.arange(self.num_classes, device=scores.device)
+        index = (classes * self.class_bins + self.get_bins(scores, self.class_bins)).reshape(-1)
+        size = self.num_classes * self.class_bins
+        self.class_positives += torch.bincount(index[y_true], minlength=size).cpu().type(torch.int32)
+        self.class_negatives += torch.bincount(index[~y_true], minlength=size).cpu().type(torch.int32)
+
+    def get_counts(self, micro=False):
+        if micro:
+            positives, negatives = self.positives[:, None], self.negatives[:, None]
+        else:
+            positives = self.class_positives.reshape(self.num_classes, self.class_bins).T
+            negatives = self.class_negatives.reshape(self.num_classes, self.class_bins).T
+        positives, negatives = positives.type(torch.float64), negatives.type(torch.float64)
+        return torch.cumsum(positives, dim=0), torch.cumsum(negatives, dim=0), (positives + negatives) > 0
+
+    def average_precision(self):
+        return get_average_precision(*self.get_counts())
+
+    def precision_recall_curve(self):
+        tp, fp, is_last = self.get_counts(micro=True)
+        tp, fp = tp[is_last], fp[is_last]
+        return tp / (tp + fp), tp / tp[-1].clamp(min=1)
+
+    def get_average_precision_summary(self):
+        per_class = self.average_precision()
+        micro = get_average_precision(*self.get_counts(micro=True))[0]
+        return per_class, micro, torch.nanmean(per_class)
+
+
+class ScoreAccumulator:
+    """
+    Scores the probe embeddings of every embedder and mask against the L2 normalized target embeddings (gallery) of
+    the identities, one matmul per (embedder, mask) and batch. The [probes, identities] cosine score matrices and the
+    true labels stay on the device of the gallery until the end of the run.
+    With num_bins the average precision is approximated with streaming histograms instead, the score matrices are not
+    kept and there are no preds to save.
+    Galleries of more than dense_max_identities only keep the blocked top_k search results (of the approximate index,
+    if any) and the true identity score of every probe, the average precision and the preds are computed from them.
+    The galleries are GalleryIndex objects stored as dtype, with an approximate index_type every batch is also searched
+    approximately and the recall@top_k against the exact search and the throughput are accumulated.
+    """
+    def __init__(self, galleries, mask_names, num_bins=None, dtype='fp32', index_type='exact', top_k=5,
+                 dense_max_identities=4096):
+        self.galleries = {emb_name: GalleryIndex(gallery, dtype=dtype, device=gallery.device)
+                          for emb_name, gallery in galleries.items()}
+        self.mask_names = mask_names
+        self.top_k = top_k
+        self.approximate_galleries = None
+        if index_type != 'exact':
+            self.approximate_galleries = {emb_name: build_gallery_index(gallery, index_type, dtype, gallery.device)
+                                          for emb_name, gallery in galleries.items()}
+        # probes, recall sum, approximate seconds, exact seconds of every (embedder, mask)
+        self.search_stats = {}
+        self.scores = {(emb_name, mask_name): [] for emb_name in self.galleries.keys() for mask_name in mask_names}
+        self.labels = []
+        self.histograms = None
+        if num_bins is not None:
+            self.histograms = {key: StreamingAveragePrecision(self.num_classes, num_bins) for key in self.scores.keys()}
+        self.dense = num_bins is None and self.num_classes <= dense_max_identities
+
+    @property
+    def device(self):
+        return next(iter(self.galleries.values())).device
+
+    @property
+    def num_classes(self):
+        return len(next(iter(self.galleries.values())))
+
+    @torch.no_grad()
+    def update(self, all_embeddings, cls_id):
+        """
+        all_embeddings is {emb_name: [probe embeddings of every mask]}, in the order of mask_names.
+        """
+        cls_id = cls_id.to(torch.int64).to(self.device)
+        for emb_name, gallery in self.galleries.items():
+            for mask_name, emb in zip(self.mask_names, all_embeddings[emb_name]):
+                if self.histograms is not None:
+                    self.histograms[(emb_name, mask_name)].update(get_one_hot(cls_id, self.num_classes), gallery.score(emb))
+                elif self.dense:
+                    self.scores[(emb_name, mask_name)].append(gallery.score(emb))
+                else:
+                    search_gallery = gallery if self.approximate_galleries is None else self.approximate_galleries[emb_name]
+                    top_scores, top_ids = search_gallery.search(emb, self.top_k)
+                    self.scores[(emb_name, mask_name)].append((top_scores, top_ids, gallery.score_pairs(emb, cls_id)))
+                if self.approximate_galleries is not None:
+                    self.update_search_stats(emb_name, mask_name, emb)
+        self.labels.append(cls_id)
+
+    def update_search_stats(self, emb_name, mask_name, emb):
+        recall, throughput, exact_throughput = evaluate_index(self.approximate_galleries[emb_name],
+                                                              self.galleries[emb_name], emb, self.top_k)
+        stats = self.search_stats.setdefault((emb_name, mask_name), [0, 0., 0., 0.])
+        stats[0] += len(emb)
+        stats[1] += recall * len(emb)
+        stats[2] += len(emb) / throughput
+        stats[3] += len(emb) / exact_throughput
+
+    def get_search_stats(self, emb_name, mask_name):
+        """
+        Returns the recall@top_k of the approximate search and the throughput (probes per second) of the approximate
+        and the exact search.
+        """
+        probes, recall, seconds, exact_seconds = self.search_stats[(emb_name, mask_name)]
+        return recall / probes, probes / seconds, probes / exact_seconds
+
+    def get_labels(self):
+        return torch.cat(self.labels)
+
+    def get_scores(self, emb_name, mask_name):
+        return torch.cat(self.scores[(emb_name, mask_name)])
+
+    def get_top_k(self, emb_name, mask_name):
+        """
+        Returns the concatenated top-k scores, top-k ids and true identity scores.
+        """
+        return [torch.cat(chunks) for chunks in zip(*self.scores[(emb_name, mask_name)])]
+
+    def get_top_k_entries(self, emb_name, mask_name):
+        """
+        Flat (class, score, is positive) entries of the retained scores, the top-k ids other than the true identity are
+        the negatives and the true identity scores the positives.
+        """
+        labels = self.get_labels()
+        top_scores, top_ids, true_scores = self.get_top_k(emb_name, mask_name)
+        negatives = (top_ids != labels[:, None]) & (top_ids >= 0)
+        classes = torch.cat([top_ids[negatives], labels])
+        scores = torch.cat([top_scores[negatives], true_scores])
+        y_true = torch.cat([torch.zeros(int(negatives.sum()), dtype=torch.bool, device=self.device),
+                            torch.ones(len(labels), dtype=torch.bool, device=self.device)])
+        return classes, scores, y_true
+
+    def get_average_precision_summary(self, emb_name, mask_name):
+        if self.histograms is not None:
+            return self.histograms[(emb_name, mask_name)].get_average_precision_summary()
+        if not self.dense:
+            classes, scores, y_true = self.get_top_k_entries(emb_name, mask_name)
+            per_class = sparse_average_precision(classes, scores, y_true, self.num_classes)
+            micro = sparse_average_precision(torch.zeros_like(classes), scores, y_true, 1)[0]
+            return per_class, micro, torch.nanmean(per_class)
+        y_true = get_one_hot(self.get_labels(), self.num_classes)
+        return get_average_precision_summary(y_true, self.get_scores(emb_name, mask_name))
+
+    def precision_recall_curve(self, emb_name, mask_name):
+        """
+        Micro averaged precision recall curve.
+        """
+        if self.histograms is not None:
+            return self.histograms[(emb_name, mask_name)].precision_recall_curve()
+        if not self.dense:
+            _, scores, y_true = self.get_top_k_entries(emb_name, mask_name)
+            _, tp, fp, _, _, is_last = get_sparse_threshold_counts(torch.zeros_like(scores, dtype=torch.int64), scores, y_true)
+            tp, fp = tp[is_last], fp[is_last]
+            return tp / (tp + fp), tp / tp[-1].clamp(min=1)
+        y_true = get_one_hot(self.get_labels(), self.num_classes)
+        return precision_recall_curve(y_true, self.get_scores(emb_name, mask_name))
+
+    def to_dataframe(self):
+        """
+        Rows of (emb_name, mask_name, y_true, y_pred) with the one hot labels and the scores of every probe as lists,
+        the layout of the saved preds csv files. None when the scores are only streamed into histograms.
+        Large galleries save the label (y_true), the top-k ids and scores and the true identity score of every probe.
+        """
+        if self.histograms is not None:
+            return None
+        if not self.dense:
+            labels = self.get_labels().cpu().numpy().tolist()
+            frames = []
+            for (emb_name, mask_name) in self.scores.keys():
+                top_scores, top_ids, true_scores = [t.cpu().numpy().tolist() for t in self.get_top_k(emb_name, mask_name)]
+                frames.append(pd.DataFrame({'emb_name': emb_name,
+                                            'mask_name': mask_name,
+                                            'y_true': labels,
+                                            'y_pred_ids': top_ids,
+                                            'y_pred': top_scores,
+                                            'y_true_score': true_scores}))
+            return pd.concat(frames, ignore_index=True)
+        y_true = get_one_hot(self.get_labels(), self.num_classes).type(torch.int64).cpu().numpy().tolist()
+        frames = []
+        for (emb_name, mask_name) in self.scores.keys():
+            frames.append(pd.DataFrame({'emb_name': emb_name,
+                                        'mask_name': mask_name,
+                                        'y_true': y_true,
+                                        'y_pred': self.get_scores(emb_name, mask_name).cpu().numpy().tolist()}))
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,44 @@
+import os
+from pathlib import Path
+
+import torch
+
+weights_cache_dir = os.path.join('..', 'weights_cache')
+
+
+class ModelRegistry:
+    """
+    In process cache of the loaded models, keyed by (name, device), so consecutive runs (e.g. train_multiple.py) share
+    the already initialized and frozen modules instead of loading them again. Precision is not part of the key, the
+    weights stay in fp32 and autocast is applied around the calls.
+    Converted checkpoints are saved to cache_dir and later loaded memory mapped, which also makes a cold start cheap.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.models = {}
+
+    def get(self, name, device, build_fn):
+        key = (name, str(device))
+        if key not in self.models:
+            self.models[key] = build_fn()
+        return self.models[key]
+
+    def load_state_dict(self, name, weights_path, convert_fn=None):
+        """
+        Returns the state dict of the checkpoint at weights_path after convert_fn, memory mapped from the cache.
+        The cache is rebuilt when the checkpoint is newer.
+        """
+        cache_path = os.path.join(self.cache_dir, name + '.pt')
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(weights_path):
+            sd = torch.load(weights_path, map_location='cpu')
+            if convert_fn is not None:
+                sd = convert_fn(sd)
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+            torch.save(sd, cache_path)
+        return torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+
+    def clear(self):
+        self.models.clear()
+
+
+registry = ModelRegistry(weights_cache_dir)
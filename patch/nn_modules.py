@@ -1,10 +1,9 @@
 import torch.nn as nn
 import torch
 import math
-import numpy as np
 import torch.nn.functional as F
+import torch.fx
 from landmark_detection.face_alignment.face_alignment import FaceAlignment
-from torchvision import transforms
 
 import kornia
 from kornia.losses import total_variation
@@ -12,8 +11,9 @@ from kornia.utils import create_meshgrid
 
 from prnet.prnet import PRNet
 import render
-
-from PIL import Image
+from assets import get_asset
+from prnet_inference import build_inference_prnet
+from model_registry import registry
 
 
 class LandmarkExtractor(nn.Module):
@@ -32,7 +32,7 @@ class LandmarkExtractor(nn.Module):
             preds = torch.tensor(single_face_points, device=self.device)
         else:
             with torch.no_grad():
-                preds = self.face_align(img_batch)[0].view(img_batch.shape[0], -1, 2)
+                preds = self.face_align(img_batch)[0].type(torch.float32).view(img_batch.shape[0], -1, 2)
                 preds[..., 0] = preds[..., 0] * self.img_size_height
                 preds[..., 1] = preds[..., 1] * self.img_size_width
                 preds = preds.type(torch.int)
@@ -40,9 +40,10 @@ class LandmarkExtractor(nn.Module):
 
 
 class FaceXZooProjector(nn.Module):
-    def __init__(self, device, img_size, patch_size):
+    def __init__(self, device, img_size, patch_size, rasterizer='dense', cull_mask_region=False, mesh_lod=1,
+                 memory_budget=None):
         super(FaceXZooProjector, self).__init__()
-        self.prn = PRN('../prnet/prnet.pth', device, patch_size[0])
+        self.prn = registry.get('prnet', device, lambda: PRN('../prnet/prnet.pth', device))
 
         self.img_size_width = img_size[1]
         self.img_size_height = img_size[0]
@@ -50,7 +51,9 @@ class FaceXZooProjector(nn.Module):
         self.patch_size_height = patch_size[0]
 
         self.device = device
-        self.uv_mask_src = transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L')).to(device).unsqueeze(0)
+        self.rasterizer = rasterizer
+        self.memory_budget = memory_budget
+        self.uv_mask_src = get_asset('../prnet/new_uv.png', device).unsqueeze(0)
 
         image_info = torch.nonzero(self.uv_mask_src, as_tuple=False)
         left, _ = torch.min(image_info[:, 3], dim=0)
@@ -60,10 +63,19 @@ class FaceXZooProjector(nn.Module):
         bottom, _ = torch.max(image_info[:, 2], dim=0)
         self.mask_half_height = ((bottom - top) / 2)
         self.patch_bbox = self.get_bbox(self.uv_mask_src)
+        self.grid = create_meshgrid(self.img_size_height, self.img_size_width, False, device=device)
 
-        self.uv_face_src = transforms.ToTensor()(Image.open('../prnet/uv_face_mask.png').convert('L')).to(
-            device).unsqueeze(0)
-        self.triangles = torch.from_numpy(np.loadtxt('../prnet/triangles.txt').astype(np.int64)).T.to(device)
+        self.uv_face_src = get_asset('../prnet/uv_face_mask.png', device).unsqueeze(0)
+        self.mesh_lod = self.get_mesh_lod(mesh_lod, img_size)
+        if self.mesh_lod == 1:
+            self.triangles = self.prn.triangles.T
+            self.face_ind = self.prn.face_ind
+        else:
+            self.triangles = get_asset('../prnet/lod/triangles_' + str(self.mesh_lod) + '.txt', device).T
+            self.face_ind = get_asset('../prnet/lod/face_ind_' + str(self.mesh_lod) + '.txt', device)
+        self.cull_mask_region = cull_mask_region
+        self.mask_region_margin = 2
+        self.mask_regions = {}
         self.minangle = -5 / 180 * math.pi
         self.maxangle = 5 / 180 * math.pi
         self.min_trans_x = -0.05
@@ -76,11 +88,69 @@ class FaceXZooProjector(nn.Module):
         self.max_brightness = 0.1
         self.noise_factor = 0.05
 
-    def forward(self, img_batch, landmarks, adv_patch, uv_mask_src=None, do_aug=False, is_3d=False):
-        pos_orig, vertices_orig = self.get_vertices(img_batch, landmarks)
+    def forward(self, img_batch, landmarks, adv_patch, uv_mask_src=None, do_aug=False, is_3d=False, mask_key=None,
+                pos=None):
+        texture = dict(adv_patch=adv_patch, uv_mask_src=uv_mask_src, is_3d=is_3d, mask_key=mask_key)
+        return self.project_textures(img_batch, landmarks, [texture], do_aug=do_aug, pos=pos)[0]
+
+    def project_textures(self, img_batch, landmarks, textures, do_aug=False, pos=None):
+        """
+        Applies several masks to the same images, textures is a list of dicts with the adv_patch, uv_mask_src, is_3d
+        and mask_key arguments of forward. The landmarks, PRNet geometry and face texture are computed once and all
+        textures are rendered in a single pass, stacked along the channel dimension.
+        A precomputed PRNet position map (see GeometryCache) can be passed as pos.
+        Returns a list with the applied image batch of every texture.
+        """
+        pos_orig, vertices_orig, texture_img = self.get_geometry(img_batch, landmarks, pos)
+
+        new_textures, uv_masks, mask_keys = [], [], []
+        for texture in textures:
+            texture_patch, uv_mask_src = self.get_texture_patch(img_batch, landmarks, pos_orig, texture['adv_patch'],
+                                                                texture.get('uv_mask_src'), texture.get('is_3d', False))
+            if do_aug:
+                texture_patch, uv_mask_src = self.augment_patch(texture_patch, uv_mask_src)
+            new_textures.append(texture_patch * uv_mask_src + texture_img * (1 - uv_mask_src))
+            uv_masks.append(uv_mask_src)
+            mask_keys.append(texture.get('mask_key'))
+        new_texture = torch.cat(new_textures, dim=1)
+
+        triangles, face_ind = self.triangles, self.face_ind
+        in_regions = torch.ones((len(textures), triangles.shape[1]), dtype=torch.bool, device=self.device)
+        if self.cull_mask_region:
+            in_regions = self.get_mask_region(uv_masks, keys=[None] if do_aug else mask_keys)
+            # the occluders of the region stay in the depth test but are never shaded with a texture
+            kept = in_regions.any(dim=0) | self.get_occluders(vertices_orig, in_regions.any(dim=0))
+            vertex_ids, triangles = torch.unique(self.triangles[:, kept], return_inverse=True)
+            in_regions = in_regions[:, kept]
+            vertices_orig = vertices_orig[..., vertex_ids]
+            face_ind = self.face_ind[vertex_ids]
+
+        b = img_batch.shape[0]
+        band_height = render.get_band_height(self.rasterizer, b, self.img_size_height, self.img_size_width,
+                                             triangles.shape[1], self.memory_budget)
+        pix_to_face = render.rasterize(vertices_orig, triangles, b, self.img_size_height, self.img_size_width,
+                                       self.rasterizer, band_height)
+        new_image = render.RenderTexture.apply(new_texture.view(b, new_texture.shape[1], -1), face_ind, triangles,
+                                               pix_to_face)
+        # every texture only covers the pixels of the triangles in its own mask region
+        in_regions = torch.cat([in_regions, in_regions.new_zeros((len(textures), 1))], dim=1)
+        face_mask = in_regions[:, pix_to_face].transpose(0, 1).repeat_interleave(img_batch.shape[1], dim=1)
+        face_mask = face_mask.type(img_batch.dtype)
+        new_image = img_batch.repeat(1, len(textures), 1, 1) * (1 - face_mask) + (new_image * face_mask)
+        new_image.data.clamp_(0, 1)
+
+        return list(new_image.split(img_batch.shape[1], dim=1))
+
+    def get_geometry(self, img_batch, landmarks, pos=None):
+        if pos is None:
+            pos_orig, vertices_orig = self.get_vertices(img_batch, landmarks)
+        else:
+            pos_orig, vertices_orig = pos, self.prn.get_vertices(pos, self.face_ind)
         texture_img = kornia.geometry.remap(img_batch, map_x=pos_orig[:, 0], map_y=pos_orig[:, 1],
                                             mode='nearest') * self.uv_face_src
+        return pos_orig, vertices_orig, texture_img
 
+    def get_texture_patch(self, img_batch, landmarks, pos_orig, adv_patch, uv_mask_src=None, is_3d=False):
         adv_patch = adv_patch.expand(img_batch.shape[0], -1, -1, -1)
         if not is_3d:
             adv_patch_other = self.align_patch(adv_patch, landmarks)
@@ -94,82 +164,123 @@ class FaceXZooProjector(nn.Module):
                 adv_patch = F.interpolate(adv_patch, (256, 256))
                 uv_mask_src = F.interpolate(uv_mask_src, (256, 256))
             texture_patch = adv_patch
+        return texture_patch, uv_mask_src
+
+    def get_mesh_lod(self, mesh_lod, img_size):
+        """
+        Picks the coarsest mesh whose UV grid stride still keeps about one vertex per output pixel.
+        Simplified meshes are built by build_mesh_lod.py. Their vertices sit on a stride lod grid of the UV map, so only
+        those texels of the patch are rendered and get a gradient, the lod should stay 1 while optimizing a patch.
+        """
+        if mesh_lod != 'auto':
+            return mesh_lod
+        ratio = self.prn.resolution / max(img_size)
+        return max((lod for lod in (1, 2, 4) if lod <= ratio), default=1)
+
+    def get_mask_region(self, uv_masks, keys):
+        """
+        Returns a [n_masks, n_triangles] map of the triangles touching the non-zero area of each uv mask, any pixel
+        outside of these areas is taken from the original image anyway.
+        Regions of fixed mask templates are cached under their keys.
+        """
+        key = None if None in keys else tuple(keys)
+        if key is not None and key in self.mask_regions:
+            return self.mask_regions[key]
+        kernel_size = 2 * self.mask_region_margin + 1
+        in_regions = []
+        for uv_mask in uv_masks:
+            region = F.max_pool2d((uv_mask.sum(dim=0, keepdim=True) > 0).type(torch.float32),
+                                  kernel_size=kernel_size, stride=1, padding=self.mask_region_margin)
+            vertex_in_region = region.view(-1)[self.face_ind] > 0
+            in_regions.append(vertex_in_region[self.triangles].any(dim=0))
+        in_regions = torch.stack(in_regions)
+        if key is not None:
+            self.mask_regions[key] = in_regions
+        return in_regions
+
+    @torch.no_grad()
+    def get_occluders(self, vertices, in_region):
+        """
+        The triangles whose screen bbox overlaps the bbox of the in_region triangles in any image of the batch, only
+        these can hide a pixel of the region in the depth test (e.g. the nose or the far cheek in non-frontal poses).
+        """
+        umins, umaxs, vmins, vmaxs = render.get_triangle_bboxes(vertices, self.triangles, self.img_size_height,
+                                                                self.img_size_width)
+        if not in_region.any():
+            return in_region
+        left, right = umins[:, in_region].amin(dim=1, keepdim=True), umaxs[:, in_region].amax(dim=1, keepdim=True)
+        top, bottom = vmins[:, in_region].amin(dim=1, keepdim=True), vmaxs[:, in_region].amax(dim=1, keepdim=True)
+        overlaps = (umins <= right) & (umaxs >= left) & (vmins <= bottom) & (vmaxs >= top)
+        return overlaps.any(dim=0)
+
+    def get_patch_placement(self, landmarks):
+        """
+        Per sample scale and translation mapping the patch bbox onto a rectangle aligned to the nose and mouth
+        landmarks, both rectangles are axis aligned so no homography is needed.
+        """
+        max_side_dist = torch.maximum(landmarks[:, 33, 0]-landmarks[:, 2, 0], landmarks[:, 14, 0]-landmarks[:, 33, 0])
+        max_side_dist = torch.where(max_side_dist < self.mask_half_width, self.mask_half_width, max_side_dist)
 
-        if do_aug:
-            texture_patch, uv_mask_src = self.augment_patch(texture_patch, uv_mask_src)
-
-        new_texture = texture_patch * uv_mask_src + texture_img * (1 - uv_mask_src)
-
-        new_colors = self.prn.get_colors_from_texture(new_texture)
-
-        face_mask, new_image = render.render_cy_pt(vertices_orig,
-                                                   new_colors,
-                                                   self.triangles,
-                                                   img_batch.shape[0],
-                                                   self.img_size_height,
-                                                   self.img_size_width,
-                                                   self.device)
-        face_mask = torch.where(torch.floor(face_mask) > 0,
-                                torch.ones(1, device=self.device),
-                                torch.zeros(1, device=self.device))
-        new_image = img_batch * (1 - face_mask) + (new_image * face_mask)
-        new_image.data.clamp_(0, 1)
-
-        return new_image
+        dst_left_top = torch.stack((landmarks[:, 33, 0]-max_side_dist, landmarks[:, 62, 1]-self.mask_half_height), dim=-1)
+        dst_size = torch.stack((2 * max_side_dist, 2 * self.mask_half_height.expand_as(max_side_dist)), dim=-1)
+        src_left_top, src_right_bottom = self.patch_bbox[:, 0], self.patch_bbox[:, 3]
+        scale = dst_size / (src_right_bottom - src_left_top)
+        translation = dst_left_top - scale * src_left_top
+        return scale, translation
 
     def align_patch(self, adv_patch, landmarks):
-        batch_size = landmarks.shape[0]
-        src_pts = self.patch_bbox.repeat(batch_size, 1, 1)
-
         landmarks = landmarks.type(torch.float32)
-        max_side_dist = torch.maximum(landmarks[:, 33, 0]-landmarks[:, 2, 0], landmarks[:, 14, 0]-landmarks[:, 33, 0])
-        max_side_dist = torch.where(max_side_dist < self.mask_half_width, self.mask_half_width, max_side_dist)
-
-        left_top = torch.stack((landmarks[:, 33, 0]-max_side_dist, landmarks[:, 62, 1]-self.mask_half_height), dim=-1)
-        right_top = torch.stack((landmarks[:, 33, 0]+max_side_dist, landmarks[:, 62, 1]-self.mask_half_height), dim=-1)
-        left_bottom = torch.stack((landmarks[:, 33, 0]-max_side_dist,  landmarks[:, 62, 1]+self.mask_half_height), dim=-1)
-        right_bottom = torch.stack((landmarks[:, 33, 0]+max_side_dist, landmarks[:, 62, 1]+self.mask_half_height), dim=-1)
-        dst_pts = torch.stack([left_top, right_top, left_bottom, right_bottom], dim=1)
-
-        tform = kornia.find_homography_dlt(src_pts, dst_pts)
-        cropped_image = kornia.geometry.warp_perspective(adv_patch, tform, dsize=(self.img_size_width, self.img_size_height), mode='nearest')
-
-        grid = create_meshgrid(112, 112, False, device=self.device).repeat(batch_size, 1, 1, 1)
-
-        for i in range(batch_size):
-            bbox_info = self.get_bbox(cropped_image[i:i+1])
-            left_top = bbox_info[:, 0]
-            right_top = bbox_info[:, 1]
-            x_center = (right_top[:, 0] - left_top[:, 0]) / 2
-            target_y = torch.mean(torch.stack([landmarks[i, 0, 1], landmarks[i, 0, 1]]))
-            max_y_left = torch.clamp_min(-(target_y - left_top[:, 1]), 0)
-            start_idx_left = min(int(left_top[0, 0].item()), self.img_size_width)
-            end_idx_left = min(int(start_idx_left + x_center), self.img_size_width)
-            offset = torch.zeros_like(grid[i, :, start_idx_left:end_idx_left, 1])
-            dropoff = 0.97
-            for j in range(offset.shape[1]):
-                offset[:, j] = (max_y_left - ((j*max_y_left)/offset.shape[1])) * dropoff
-
-            grid[i, :, start_idx_left:end_idx_left, 1] = grid[i, :, start_idx_left:end_idx_left, 1] + offset
-
-            target_y = torch.mean(torch.stack([landmarks[i, 16, 1], landmarks[i, 16, 1]]))
-            max_y_right = torch.clamp_min(-(target_y - right_top[:, 1]), 0)
-            end_idx_right = min(int(right_top[0, 0].item()), self.img_size_width) + 1
-            start_idx_right = min(int(end_idx_right - x_center), self.img_size_width)
-            offset = torch.zeros_like(grid[i, :, start_idx_right:end_idx_right, 1])
-            for idx, col in enumerate(reversed(range(offset.shape[1]))):
-                offset[:, col] = (max_y_right - ((idx*max_y_right)/offset.shape[1])) * dropoff
-            grid[i, :, start_idx_right:end_idx_right, 1] = grid[i, :, start_idx_right:end_idx_right, 1] + offset
-
-        cropped_image = kornia.remap(cropped_image, map_x=grid[..., 0], map_y=grid[..., 1], mode='nearest')
+        scale, translation = self.get_patch_placement(landmarks)
+
+        # bbox of the placed patch, nearest sampling extends it by half a patch pixel on every side
+        img_size = torch.tensor([self.img_size_width - 1, self.img_size_height - 1], device=self.device)
+        left_top = torch.ceil(translation + scale * (self.patch_bbox[:, 0] - 0.5))
+        left_top = torch.minimum(torch.clamp_min(left_top, 0), img_size)
+        right_bottom = torch.floor(translation + scale * (self.patch_bbox[:, 3] + 0.5))
+        right_bottom = torch.maximum(torch.minimum(right_bottom, img_size), left_top)
+        right_top = torch.stack((right_bottom[:, 0], left_top[:, 1]), dim=-1)
+
+        # drop the top corners of the patch towards the jaw line landmarks
+        x_center = (right_top[:, 0] - left_top[:, 0]) / 2
+        cols = torch.arange(self.img_size_width, device=self.device).unsqueeze(0)
+
+        max_y_left = torch.clamp_min(-(landmarks[:, 0, 1] - left_top[:, 1]), 0)
+        start_idx_left = left_top[:, 0].long().clamp(max=self.img_size_width)
+        end_idx_left = (start_idx_left + x_center).long().clamp(max=self.img_size_width)
+        offset_left = self.get_droop_offset(cols, cols - start_idx_left.unsqueeze(1), start_idx_left, end_idx_left, max_y_left)
+
+        max_y_right = torch.clamp_min(-(landmarks[:, 16, 1] - right_top[:, 1]), 0)
+        end_idx_right = right_top[:, 0].long().clamp(max=self.img_size_width) + 1
+        start_idx_right = (end_idx_right - x_center).long().clamp(max=self.img_size_width)
+        offset_right = self.get_droop_offset(cols, end_idx_right.unsqueeze(1) - 1 - cols, start_idx_right, end_idx_right, max_y_right)
+
+        # a single sampling grid for the placement and the droop, from image pixels back to patch pixels
+        map_x = (self.grid[..., 0] - translation[:, 0, None, None]) / scale[:, 0, None, None]
+        map_y = (self.grid[..., 1] + offset_left.unsqueeze(1) + offset_right.unsqueeze(1) - translation[:, 1, None, None]) / scale[:, 1, None, None]
+        grid = torch.stack((map_x / (adv_patch.shape[3] - 1), map_y / (adv_patch.shape[2] - 1)), dim=-1) * 2 - 1
+        cropped_image = F.grid_sample(adv_patch, grid, mode='nearest', padding_mode='zeros', align_corners=True)
         return cropped_image
 
+    @staticmethod
+    def get_droop_offset(cols, steps, start_idx, end_idx, max_y, dropoff=0.97):
+        """
+        Vertical offsets of the columns [start_idx, end_idx) decaying linearly from max_y, steps counts the columns
+        from the one with the full offset.
+        """
+        length = (end_idx - start_idx).clamp(min=1).unsqueeze(1)
+        max_y = max_y.unsqueeze(1)
+        offset = (max_y - ((steps * max_y) / length)) * dropoff
+        in_range = (cols >= start_idx.unsqueeze(1)) & (cols < end_idx.unsqueeze(1))
+        return torch.where(in_range, offset, torch.zeros(1, device=offset.device))
+
     def get_bbox(self, adv_patch):
-        image_info = torch.nonzero(adv_patch, as_tuple=False).unsqueeze(0)
-        left, _ = torch.min(image_info[:, :, 3], dim=1)
-        right, _ = torch.max(image_info[:, :, 3], dim=1)
-        top, _ = torch.min(image_info[:, :, 2], dim=1)
-        bottom, _ = torch.max(image_info[:, :, 2], dim=1)
+        occupied = (adv_patch != 0).any(dim=1)
+        rows = occupied.any(dim=2).type(torch.uint8)
+        cols = occupied.any(dim=1).type(torch.uint8)
+        left = cols.argmax(dim=1)
+        right = cols.shape[1] - 1 - cols.flip(1).argmax(dim=1)
+        top = rows.argmax(dim=1)
+        bottom = rows.shape[1] - 1 - rows.flip(1).argmax(dim=1)
         width = right - left
         height = bottom - top
         # crop image
@@ -183,7 +294,7 @@ class FaceXZooProjector(nn.Module):
 
     def get_vertices(self, image, face_lms):
         pos = self.prn.process(image, face_lms)
-        vertices = self.prn.get_vertices(pos)
+        vertices = self.prn.get_vertices(pos, self.face_ind)
         return pos, vertices
 
     def augment_patch(self, adv_patch, uv_mask_src):
@@ -223,15 +334,16 @@ class PRN:
     based on:
     https://github.com/YadiraF/PRNet/blob/master/api.py
     """
-    def __init__(self, model_path, device):
+    def __init__(self, model_path, device, channels_last=None):
         self.resolution = 256
         self.MaxPos = self.resolution * 1.1
-        self.face_ind = np.loadtxt('../prnet/face_ind.txt').astype(np.int32)
-        self.triangles = np.loadtxt('../prnet/triangles.txt').astype(np.int32)
+        self.face_ind = get_asset('../prnet/face_ind.txt', device)
+        self.triangles = get_asset('../prnet/triangles.txt', device)
         self.net = PRNet(3, 3)
-        self.net.load_state_dict(torch.load(model_path))
+        self.net.load_state_dict(registry.load_state_dict('prnet', model_path))
         self.device = device
-        self.net.to(device).eval()
+        self.channels_last = torch.device(device).type == 'cuda' if channels_last is None else channels_last
+        self.net = build_inference_prnet(self.net.to(device), channels_last=self.channels_last)
 
     def get_bbox_annot(self, image_info):
         left, _ = torch.min(image_info[..., 0], dim=1)
@@ -259,34 +371,42 @@ class PRN:
                                 [self.resolution - 1, self.resolution - 1]],
                                dtype=torch.float32, device=self.device).repeat(src_pts.shape[0], 1, 1)
 
-        tform = kornia.get_perspective_transform(src_pts, dst_pts)
+        tform = kornia.geometry.transform.get_perspective_transform(src_pts, dst_pts)
         cropped_image = kornia.geometry.warp_perspective(img_batch, tform, dsize=(self.resolution, self.resolution))
 
         return cropped_image, tform
 
+    @torch.no_grad()
     def process(self, img_batch, image_info):
         cropped_image, tform = self.preprocess(img_batch, image_info)
+        if self.channels_last:
+            cropped_image = cropped_image.contiguous(memory_format=torch.channels_last)
+
+        cropped_pos = self.net(cropped_image).contiguous()
 
-        cropped_pos = self.net(cropped_image)
-        cropped_vertices = (cropped_pos * self.MaxPos).view(cropped_pos.shape[0], 3, -1)
+        # the position map is mapped back to image coordinates in fp32, fp16 can not resolve sub-pixel positions
+        with torch.autocast(img_batch.device.type, enabled=False):
+            cropped_vertices = (cropped_pos.type(torch.float32) * self.MaxPos).view(cropped_pos.shape[0], 3, -1)
 
-        z = cropped_vertices[:, 2:3, :].clone() / tform[:, :1, :1]
-        cropped_vertices[:, 2, :] = 1
+            z = cropped_vertices[:, 2:3, :].clone() / tform[:, :1, :1]
+            cropped_vertices[:, 2, :] = 1
 
-        vertices = torch.bmm(torch.linalg.inv(tform), cropped_vertices)
-        vertices = torch.cat((vertices[:, :2, :], z), dim=1)
+            vertices = torch.bmm(torch.linalg.inv(tform), cropped_vertices)
+            vertices = torch.cat((vertices[:, :2, :], z), dim=1)
 
         pos = vertices.reshape(vertices.shape[0], 3, self.resolution, self.resolution)
         return pos
 
-    def get_vertices(self, pos):
+    def get_vertices(self, pos, face_ind=None):
+        face_ind = self.face_ind if face_ind is None else face_ind
         all_vertices = pos.view(pos.shape[0], 3, -1)
-        vertices = all_vertices[..., self.face_ind]
+        vertices = all_vertices[..., face_ind]
         return vertices
 
-    def get_colors_from_texture(self, texture):
+    def get_colors_from_texture(self, texture, face_ind=None):
+        face_ind = self.face_ind if face_ind is None else face_ind
         all_colors = texture.view(texture.shape[0], 3, -1)
-        colors = all_colors[..., self.face_ind]
+        colors = all_colors[..., face_ind]
         return colors
 
 
@@ -294,16 +414,131 @@ class TotalVariation(nn.Module):
     def __init__(self, device) -> None:
         super(TotalVariation, self).__init__()
         self.device = device
-        self.uv_mask_src = transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L')).to(device).squeeze()
+        self.uv_mask_src = get_asset('../prnet/new_uv.png', device).squeeze()
         self.number_of_pixels = torch.count_nonzero(self.uv_mask_src)
         self.save_grads = torch.zeros_like(self.uv_mask_src)
 
     def forward(self, adv_patch):
         tv_patch = adv_patch * self.uv_mask_src
-        loss = total_variation(tv_patch) / self.number_of_pixels
+        # kornia >= 0.7 only reduces over H and W, the channels are summed to keep one loss per patch
+        loss = total_variation(tv_patch).sum(dim=-1) / self.number_of_pixels
+        assert loss.shape == adv_patch.shape[:1], 'TotalVariation returns one loss per patch'
         return loss
 
     def zero_grads(self, grads):
         self.save_grads = torch.where(grads.sum(dim=1).sum(dim=0).unsqueeze(0).unsqueeze(0) != 0,
                                       torch.ones(1, device=self.device),
                                       self.save_grads)
+
+
+class EmbedderEnsemble(nn.Module):
+    """
+    Runs a dict of frozen embedders as few batched calls, embedders with the same architecture (e.g. the arcface and
+    cosface heads of a backbone) are evaluated together by vmapping functional_call over their stacked weights.
+    The weights of the grouped embedders are replaced by views of the stacked tensors, so they are not duplicated and
+    the embedders can still be called one by one. The stacks are kept on the first embedder of the group, a later
+    ensemble of the same (registry shared) embedders reuses them instead of stacking the weights again.
+    Batches are split into chunks that keep the activations of every group within memory_budget bytes, so larger
+    embedders get smaller chunks.
+    Returns a dict of embeddings in the order of the embedders dict.
+    """
+    def __init__(self, embedders, memory_budget=None):
+        super(EmbedderEnsemble, self).__init__()
+        self.embedders = embedders
+        self.memory_budget = memory_budget
+        self.image_bytes = {}
+        groups = {}
+        for name, embedder in embedders.items():
+            groups.setdefault(self.get_architecture_key(embedder), []).append(name)
+        self.groups = list(groups.values())
+        self.stacked = [self.stack_group(names) if len(names) > 1 else None for names in self.groups]
+
+    @staticmethod
+    def get_architecture_key(embedder):
+        code = embedder.code if isinstance(embedder, torch.fx.GraphModule) else type(embedder).__name__
+        return code, tuple((name, tuple(t.shape)) for name, t in embedder.state_dict().items())
+
+    @staticmethod
+    def get_shared_stacks(members):
+        """
+        The (params, buffers) stacks the members were already rebound to, None if any member weight is not a view of
+        them (e.g. the members were since regrouped).
+        """
+        key, params, buffers = getattr(members[0], 'ensemble_stacks', (None, None, None))
+        if key != tuple(id(m) for m in members):
+            return None
+        for i, member in enumerate(members):
+            member_params, member_buffers = dict(member.named_parameters()), dict(member.named_buffers())
+            if any(member_params[name].data_ptr() != stacked[i].data_ptr() for name, stacked in params.items()) or \
+                    any(member_buffers[name].data_ptr() != stacked[i].data_ptr() for name, stacked in buffers.items()):
+                return None
+        return params, buffers
+
+    def stack_group(self, names):
+        members = [self.embedders[name] for name in names]
+
+        def call_member(member_params, member_buffers, x):
+            return torch.func.functional_call(members[0], (member_params, member_buffers), (x,))
+        call_group = torch.func.vmap(call_member, in_dims=(0, 0, None))
+        shared = self.get_shared_stacks(members)
+        if shared is not None:
+            return (call_group,) + shared
+
+        params = {name: torch.stack([dict(m.named_parameters())[name].detach() for m in members])
+                  for name, _ in members[0].named_parameters()}
+        buffers = {name: torch.stack([dict(m.named_buffers())[name] for m in members])
+                   for name, _ in members[0].named_buffers()}
+        for i, member in enumerate(members):
+            for name, stacked in params.items():
+                parent_name, _, param_name = name.rpartition('.')
+                member.get_submodule(parent_name)._parameters[param_name] = nn.Parameter(stacked[i], requires_grad=False)
+            for name, stacked in buffers.items():
+                parent_name, _, buffer_name = name.rpartition('.')
+                member.get_submodule(parent_name)._buffers[buffer_name] = stacked[i]
+        members[0].ensemble_stacks = (tuple(id(m) for m in members), params, buffers)
+        return call_group, params, buffers
+
+    def get_image_bytes(self, names, img_batch):
+        """
+        Activation bytes of a single image in the group, the sum of the outputs of all the leaf modules, measured once
+        per input shape and dtype on a probe image.
+        """
+        key = (tuple(names), tuple(img_batch.shape[1:]), img_batch.dtype, torch.is_autocast_enabled())
+        if key not in self.image_bytes:
+            embedder = self.embedders[names[0]]
+            output_bytes = []
+
+            def record(module, inputs, output):
+                if isinstance(output, torch.Tensor):
+                    output_bytes.append(output.numel() * output.element_size())
+            leaves = [module for module in embedder.modules() if len(list(module.children())) == 0]
+            handles = [module.register_forward_hook(record) for module in leaves]
+            try:
+                with torch.no_grad():
+                    embedder(img_batch[:1])
+            finally:
+                for handle in handles:
+                    handle.remove()
+            self.image_bytes[key] = len(names) * max(1, sum(output_bytes))
+        return self.image_bytes[key]
+
+    def get_chunk_size(self, names, img_batch):
+        if self.memory_budget is None:
+            return img_batch.shape[0]
+        return int(max(1, self.memory_budget // self.get_image_bytes(names, img_batch)))
+
+    def forward(self, img_batch):
+        embeddings = {}
+        for names, stacked in zip(self.groups, self.stacked):
+            chunk_size = self.get_chunk_size(names, img_batch)
+            group_embeddings = []
+            for chunk in img_batch.split(chunk_size):
+                if stacked is None:
+                    group_embeddings.append(self.embedders[names[0]](chunk).unsqueeze(0))
+                    continue
+                call_group, params, buffers = stacked
+                group_embeddings.append(call_group(params, buffers, chunk))
+            group_embeddings = torch.cat(group_embeddings, dim=1)
+            for name, embedding in zip(names, group_embeddings):
+                embeddings[name] = embedding
+        return {name: embeddings[name] for name in self.embedders.keys()}
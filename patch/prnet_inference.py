@@ -0,0 +1,95 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from frozen import freeze_model
+from prnet.prnet import PRNet
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def convert_transposed_convs(model):
+    """
+    Replaces the stride 1 transposed convolutions of the traced model by the equivalent convolutions (flipped kernel,
+    swapped channels, kernel_size - 1 - padding padding), the decoder blocks of PRNet are mostly of this kind.
+    """
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, nn.ConvTranspose2d) or module.stride != (1, 1) or module.groups != 1 \
+                or module.dilation != (1, 1) or module.output_padding != (0, 0):
+            continue
+        padding = tuple(k - 1 - p for k, p in zip(module.kernel_size, module.padding))
+        if min(padding) < 0:
+            continue
+        conv = nn.Conv2d(module.in_channels, module.out_channels, module.kernel_size, padding=padding,
+                         bias=module.bias is not None).to(module.weight.device)
+        conv.weight.data.copy_(module.weight.data.flip(2, 3).transpose(0, 1))
+        if module.bias is not None:
+            conv.bias.data.copy_(module.bias.data)
+        conv.requires_grad_(module.weight.requires_grad)
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, conv)
+    return model
+
+
+def build_inference_prnet(net, channels_last=False):
+    """
+    Converts a loaded PRNet into a lean inference module, tracing keeps only the padding branch each Conv2d and
+    UpBlock actually uses, BatchNorm is folded into the (transposed) convolutions and stride 1 transposed convolutions
+    become plain convolutions. The result is a frozen torch.fx.GraphModule which can be scripted or exported.
+    """
+    net = convert_transposed_convs(freeze_model(net))
+    if channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    return net
+
+
+@torch.no_grad()
+def check_parity(reference, module, inputs, atol=1e-4):
+    """
+    Max abs difference between the outputs of the reference and the converted module, raises if above atol.
+    """
+    diff = (reference(inputs) - module(inputs)).abs().max().item()
+    if diff > atol:
+        raise ValueError(f'PRNet conversion changed the output by {diff:.6f} (atol {atol})')
+    return diff
+
+
+def export_prnet(module, inputs, output_path, method='torchscript'):
+    if method == 'torchscript':
+        exported = torch.jit.trace(module, inputs)
+        torch.jit.save(exported, output_path)
+    elif method == 'export':
+        exported = torch.export.export(module, (inputs,))
+        torch.export.save(exported, output_path)
+        exported = exported.module()
+    else:
+        raise ValueError('Unknown export method ' + method)
+    return exported
+
+
+def main():
+    from benchmark import time_fn
+
+    reference = PRNet(3, 3)
+    reference.load_state_dict(torch.load('../prnet/prnet.pth', map_location=device))
+    reference = reference.to(device).eval()
+    inputs = torch.rand(8, 3, 256, 256, device=device)
+
+    candidates = {'reference': reference,
+                  'inference': build_inference_prnet(copy.deepcopy(reference)),
+                  'channels_last': build_inference_prnet(copy.deepcopy(reference), channels_last=True)}
+    candidates['torchscript'] = export_prnet(candidates['inference'], inputs, '../prnet/prnet_inference.pt')
+    candidates['export'] = export_prnet(candidates['inference'], inputs, '../prnet/prnet_inference.pt2', 'export')
+
+    with torch.no_grad():
+        reference_seconds = time_fn(lambda: reference(inputs))
+        for name, module in candidates.items():
+            diff = check_parity(reference, module, inputs)
+            seconds = time_fn(lambda: module(inputs))
+            print(f'{name:>14} | {seconds * 1000:8.2f} ms/batch ({reference_seconds / seconds:4.2f}x) | '
+                  f'max abs diff {diff:.2e}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
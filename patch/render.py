@@ -1,8 +1,15 @@
 import torch
 
 
-def render_cy_pt(vertices, new_colors, triangles, b, h, w, device):
-    new_image, face_mask = render_texture_pt(vertices, new_colors, triangles, device, b, h, w)
+def render_cy_pt(vertices, new_colors, triangles, b, h, w, device, rasterizer='dense', band_height=None):
+    new_image, face_mask = render_texture_pt(vertices, new_colors, triangles, device, b, h, w, rasterizer=rasterizer,
+                                             band_height=band_height)
+    return face_mask, new_image
+
+
+def render_uv_texture_cy_pt(vertices, texture, face_ind, triangles, b, h, w, rasterizer='dense', band_height=None):
+    new_image, face_mask = render_uv_texture_pt(vertices, texture, face_ind, triangles, b, h, w, rasterizer=rasterizer,
+                                                band_height=band_height)
     return face_mask, new_image
 
 
@@ -24,14 +31,16 @@ def get_unique_first_indices(inverse, unique_size):
     return perm
 
 
-def get_image_by_vectorization_with_unique_small(bboxes, new_tri_depth, new_tri_tex, new_triangles, vertices, h, w, device):
+def get_visible_by_vectorization_with_unique_small(bboxes, new_tri_depth, h, w, device):
+    """
+    Returns a [h, w] map with the index of the closest bbox covering each pixel (-1 for uncovered pixels).
+    """
     depth_sorted, indices = torch.sort(new_tri_depth, descending=True)
     bb_sorted = torch.index_select(input=bboxes, dim=0, index=indices)
-    texture_sorted = torch.index_select(input=new_tri_tex, dim=1, index=indices)
     bboxes_unique, inverse = torch.unique(bb_sorted, dim=0, return_inverse=True)
     uni_idx = get_unique_first_indices(inverse, bboxes_unique.size(0))
     depth_sorted = torch.index_select(input=depth_sorted, dim=0, index=uni_idx)
-    texture_sorted = torch.index_select(input=texture_sorted, dim=1, index=uni_idx)
+    indices = torch.index_select(input=indices, dim=0, index=uni_idx)
 
     points = torch.cartesian_prod(torch.arange(0, h, device=device),
                                   torch.arange(0, w, device=device))
@@ -46,33 +55,289 @@ def get_image_by_vectorization_with_unique_small(bboxes, new_tri_depth, new_tri_
 
     deep_depth_buffer = torch.zeros([h, w, mask.shape[-1]], dtype=torch.int32, device=device) - 999999.
     dp = torch.where(mask, depth_sorted, deep_depth_buffer).argmax(dim=-1)
+    return torch.where((mask.sum(dim=-1) == 0), torch.full_like(dp, -1), indices[dp])
+
+
+def get_image_by_vectorization_with_unique_small(bboxes, new_tri_depth, new_tri_tex, new_triangles, vertices, h, w, device):
+    dp = get_visible_by_vectorization_with_unique_small(bboxes, new_tri_depth, h, w, device)
 
     color_img = torch.zeros((3, h, w), device=device)
-    color_img = torch.where((mask.sum(dim=-1) == 0), color_img, texture_sorted.T[dp].permute(2, 0, 1))
+    color_img = torch.where(dp < 0, color_img, new_tri_tex.T[dp.clamp(min=0)].permute(2, 0, 1))
 
     mask_img = torch.zeros((1, h, w), device=device)
-    mask_img = torch.where((mask.sum(dim=-1) == 0), mask_img, torch.ones(1, device=device))
+    mask_img = torch.where(dp < 0, mask_img, torch.ones(1, device=device))
     return color_img, mask_img
 
 
-def render_texture_pt(vertices, colors, triangles, device, b, h, w):
-    tri_depth = (vertices[:, 2, triangles[0, :]] + vertices[:, 2, triangles[1, :]] + vertices[:, 2, triangles[2, :]]) / 3.
-    tri_tex = (colors[:, :, triangles[0, :]] + colors[:, :, triangles[1, :]] + colors[:, :, triangles[2, :]]) / 3.
+def get_tile_bins(bboxes, image_ids, n_tiles_x, n_tiles_y, tile_size):
+    """
+    Bins bounding boxes into the screen tiles they overlap, tiles of different images are kept apart using image_ids.
+    Returns the global indices of the non-empty tiles and a [tiles, max_k] table of bbox indices (-1 padded) where
+    every row keeps the bbox order of the input.
+    """
+    tx0, tx1 = bboxes[:, 0] // tile_size, bboxes[:, 1] // tile_size
+    ty0, ty1 = bboxes[:, 2] // tile_size, bboxes[:, 3] // tile_size
+    n_cols = (tx1 - tx0 + 1).long()
+    counts = n_cols * (ty1 - ty0 + 1).long()
+
+    box_ids = torch.repeat_interleave(torch.arange(bboxes.shape[0], device=bboxes.device), counts)
+    starts = torch.cumsum(counts, dim=0) - counts
+    offsets = torch.arange(box_ids.shape[0], device=bboxes.device) - starts[box_ids]
+    tile_x = tx0[box_ids] + offsets % n_cols[box_ids]
+    tile_y = ty0[box_ids] + torch.div(offsets, n_cols[box_ids], rounding_mode='floor')
+    tile_ids = image_ids[box_ids] * (n_tiles_x * n_tiles_y) + (tile_y * n_tiles_x + tile_x).long()
+
+    # stable sort keeps the boxes of every tile in their input order
+    tile_ids, order = torch.sort(tile_ids, stable=True)
+    box_ids = box_ids[order]
+    used_tiles, inverse, tile_counts = torch.unique_consecutive(tile_ids, return_inverse=True, return_counts=True)
+    tile_starts = torch.cumsum(tile_counts, dim=0) - tile_counts
+    slots = torch.arange(box_ids.shape[0], device=bboxes.device) - tile_starts[inverse]
+    bins = torch.full((used_tiles.shape[0], int(tile_counts.max())), -1, dtype=torch.long, device=bboxes.device)
+    bins[inverse, slots] = box_ids
+    return used_tiles, bins
+
+
+def rasterize_bboxes_tiled(bboxes, image_ids, b, h, w, tile_size=8):
+    """
+    Returns a [b, h, w] map with the index of the first bbox covering each pixel (-1 for uncovered pixels).
+    Each pixel is only tested against the bboxes binned into its own tile.
+    """
+    pix_to_box = torch.full((b * h * w,), -1, dtype=torch.long, device=bboxes.device)
+    if bboxes.shape[0] == 0:
+        return pix_to_box.view(b, h, w)
+    n_tiles_x = (w + tile_size - 1) // tile_size
+    n_tiles_y = (h + tile_size - 1) // tile_size
+    used_tiles, bins = get_tile_bins(bboxes, image_ids, n_tiles_x, n_tiles_y, tile_size)
+
+    tile_images = torch.div(used_tiles, n_tiles_x * n_tiles_y, rounding_mode='floor')
+    tiles = used_tiles % (n_tiles_x * n_tiles_y)
+    local = torch.arange(tile_size, device=bboxes.device)
+    ys = (torch.div(tiles, n_tiles_x, rounding_mode='floor') * tile_size).unsqueeze(1) + local
+    xs = (tiles % n_tiles_x * tile_size).unsqueeze(1) + local
+    ys = ys.unsqueeze(2).expand(-1, -1, tile_size).reshape(tiles.shape[0], -1, 1)
+    xs = xs.unsqueeze(1).expand(-1, tile_size, -1).reshape(tiles.shape[0], -1, 1)
 
+    bb = bboxes[bins.clamp(min=0)].unsqueeze(1)
+    cover = (xs >= bb[..., 0]) & (xs <= bb[..., 1]) & (ys >= bb[..., 2]) & (ys <= bb[..., 3]) & (bins >= 0).unsqueeze(1)
+    covered = cover.any(dim=-1)
+    first = torch.gather(bins, 1, cover.byte().argmax(dim=-1))
+
+    ys, xs = ys[..., 0], xs[..., 0]
+    inside = covered & (ys < h) & (xs < w)
+    pixels = (tile_images.unsqueeze(1) * h + ys) * w + xs
+    pix_to_box[pixels[inside]] = first[inside]
+    return pix_to_box.view(b, h, w)
+
+
+def get_visible_by_zbuffer(vertices, triangles, tri_depth, bboxes, b, h, w, top=0):
+    """
+    Returns a [b, h, w] map with the index of the closest triangle covering each pixel (-1 for uncovered pixels).
+    Every triangle emits a fragment for each pixel center inside it and the fragments are resolved with a per pixel
+    scatter-reduce, so memory is O(pixels + covered fragments).
+    """
+    vertices = vertices.detach()
+    n_triangles = triangles.shape[1]
+
+    # a triangle's depth rank packs both its depth order and its identity into one sortable key
+    order = torch.argsort(tri_depth.detach(), dim=1)
+    ranks = torch.empty_like(order).scatter_(1, order, torch.arange(n_triangles, device=order.device).expand(b, -1))
+
+    valid = (bboxes[..., 0] <= bboxes[..., 1]) & (bboxes[..., 2] <= bboxes[..., 3])
+    image_ids, face_ids = torch.nonzero(valid, as_tuple=True)
+    bboxes = bboxes[image_ids, face_ids].long()
+    widths = bboxes[:, 1] - bboxes[:, 0] + 1
+    counts = widths * (bboxes[:, 3] - bboxes[:, 2] + 1)
+
+    frag_ids = torch.repeat_interleave(torch.arange(face_ids.shape[0], device=face_ids.device), counts)
+    offsets = torch.arange(frag_ids.shape[0], device=face_ids.device) - (torch.cumsum(counts, dim=0) - counts)[frag_ids]
+    xs = (bboxes[frag_ids, 0] + offsets % widths[frag_ids]).type(vertices.dtype)
+    ys = (bboxes[frag_ids, 2] + torch.div(offsets, widths[frag_ids], rounding_mode='floor') + top).type(vertices.dtype)
+
+    corners = vertices[image_ids.unsqueeze(1), :2, triangles[:, face_ids].T][frag_ids]
+    edges = []
+    for i in range(3):
+        v0, v1 = corners[:, i], corners[:, (i + 1) % 3]
+        edges.append((v1[:, 0] - v0[:, 0]) * (ys - v0[:, 1]) - (v1[:, 1] - v0[:, 1]) * (xs - v0[:, 0]))
+    edges = torch.stack(edges, dim=-1)
+    inside = ((edges >= 0).all(dim=-1) | (edges <= 0).all(dim=-1)) & (edges != 0).any(dim=-1)
+
+    frag_images = image_ids[frag_ids][inside]
+    pixels = (frag_images * h + ys[inside].long() - top) * w + xs[inside].long()
+    keys = ranks[frag_images, face_ids[frag_ids][inside]]
+    zbuffer = torch.full((b * h * w,), -1, dtype=torch.long, device=vertices.device)
+    zbuffer.scatter_reduce_(0, pixels, keys, reduce='amax')
+
+    pixel_images = torch.arange(b, device=vertices.device).repeat_interleave(h * w)
+    pix_to_face = torch.where(zbuffer >= 0, order[pixel_images, zbuffer.clamp(min=0)], zbuffer)
+    return pix_to_face.view(b, h, w)
+
+
+def get_triangle_bboxes(vertices, triangles, h, w, top=0):
+    """
+    Returns the pixel bounding boxes of the triangles clipped to the rows [top, top + h), rows are relative to top.
+    """
     umins = torch.max(torch.ceil(torch.min(vertices[:, 0, triangles], dim=1)[0]).type(torch.int), torch.tensor(0, dtype=torch.int))
     umaxs = torch.min(torch.floor(torch.max(vertices[:, 0, triangles], dim=1)[0]).type(torch.int), torch.tensor(w-1, dtype=torch.int))
-    vmins = torch.max(torch.ceil(torch.min(vertices[:, 1, triangles], dim=1)[0]).type(torch.int), torch.tensor(0, dtype=torch.int))
-    vmaxs = torch.min(torch.floor(torch.max(vertices[:, 1, triangles], dim=1)[0]).type(torch.int), torch.tensor(h-1, dtype=torch.int))
+    vmins = torch.max(torch.ceil(torch.min(vertices[:, 1, triangles], dim=1)[0]).type(torch.int), torch.tensor(top, dtype=torch.int))
+    vmaxs = torch.min(torch.floor(torch.max(vertices[:, 1, triangles], dim=1)[0]).type(torch.int), torch.tensor(top+h-1, dtype=torch.int))
+    return umins, umaxs, vmins - top, vmaxs - top
+
+
+def get_triangle_attributes(vertices, colors, triangles):
+    tri_depth = (vertices[:, 2, triangles[0, :]] + vertices[:, 2, triangles[1, :]] + vertices[:, 2, triangles[2, :]]) / 3.
+    tri_tex = (colors[:, :, triangles[0, :]] + colors[:, :, triangles[1, :]] + colors[:, :, triangles[2, :]]) / 3.
+    return tri_depth, tri_tex
+
+
+def shade_pix_to_face(pix_to_face, tri_tex):
+    """
+    Paints every pixel with the color of its visible triangle, pix_to_face is a [b, h, w] map of triangle indices
+    (-1 for background).
+    """
+    b, h, w = pix_to_face.shape
+    covered = (pix_to_face >= 0).unsqueeze(1)
+    index = pix_to_face.clamp(min=0).view(b, 1, -1).expand(-1, tri_tex.shape[1], -1)
+    image = torch.gather(tri_tex, 2, index).view(b, -1, h, w)
+    image = torch.where(covered, image, torch.zeros(1, device=image.device))
+    return image, covered.type(image.dtype)
+
+
+def rasterize_dense(vertices, triangles, tri_depth, b, h, w, top=0):
+    umins, umaxs, vmins, vmaxs = get_triangle_bboxes(vertices, triangles, h, w, top)
 
     masks = (umins <= umaxs) & (vmins <= vmaxs)
 
-    image = torch.zeros((b, 3, h, w), device=device)
-    face_mask = torch.zeros((b, 1, h, w), device=device)
+    pix_to_face = torch.full((b, h, w), -1, dtype=torch.long, device=vertices.device)
     for i in range(b):
+        if not masks[i].any():
+            continue
         bboxes = torch.masked_select(torch.stack([umins[i], umaxs[i], vmins[i], vmaxs[i]]), masks[i]).view(4, -1).T
         new_tri_depth = torch.masked_select(tri_depth[i], masks[i])
-        new_tri_tex = torch.masked_select(tri_tex[i], masks[i]).view(3, -1)
-        new_triangles = torch.masked_select(triangles, masks[i]).view(3, -1)
-        image[i], face_mask[i] = get_image_by_vectorization_with_unique_small(bboxes, new_tri_depth, new_tri_tex, new_triangles, vertices[i], h, w, device)
+        dp = get_visible_by_vectorization_with_unique_small(bboxes, new_tri_depth, h, w, vertices.device)
+        # the trailing -1 maps uncovered pixels back to -1
+        face_ids = torch.cat([torch.nonzero(masks[i], as_tuple=True)[0], dp.new_full((1,), -1)])
+        pix_to_face[i] = face_ids[dp]
+
+    return pix_to_face
+
+
+def rasterize_tiled(vertices, triangles, tri_depth, b, h, w, top=0):
+    """
+    Rasterizes the whole batch in one pass, the visible triangles of all the images are packed into a single list
+    and binned into per image screen tiles.
+    """
+    bboxes = torch.stack(get_triangle_bboxes(vertices, triangles, h, w, top), dim=-1)
+
+    # boxes are depth sorted, so the first covering box of a pixel is the closest one
+    _, order = torch.sort(tri_depth, dim=1, descending=True)
+    bboxes = torch.gather(bboxes, 1, order.unsqueeze(-1).expand(-1, -1, 4))
+    valid = (bboxes[..., 0] <= bboxes[..., 1]) & (bboxes[..., 2] <= bboxes[..., 3])
+    image_ids, sorted_ids = torch.nonzero(valid, as_tuple=True)
+    pix_to_box = rasterize_bboxes_tiled(bboxes[image_ids, sorted_ids], image_ids, b, h, w)
+
+    # the trailing -1 maps uncovered pixels back to -1
+    face_ids = torch.cat([order[image_ids, sorted_ids], pix_to_box.new_full((1,), -1)])
+    return face_ids[pix_to_box]
+
+
+def rasterize_zbuffer(vertices, triangles, tri_depth, b, h, w, top=0):
+    """
+    Triangle level rasterization, unlike the bbox based rasterizers only pixels inside a triangle are painted.
+    """
+    bboxes = torch.stack(get_triangle_bboxes(vertices, triangles, h, w, top), dim=-1)
+    return get_visible_by_zbuffer(vertices, triangles, tri_depth, bboxes, b, h, w, top)
+
+
+rasterizers = {
+    'dense': rasterize_dense,
+    'tiled': rasterize_tiled,
+    'zbuffer': rasterize_zbuffer,
+}
+
+
+def get_band_height(rasterizer, b, h, w, n_triangles, memory_budget, tile_size=8):
+    """
+    Returns the number of image rows that can be rasterized at once within memory_budget bytes.
+    The per pixel costs are rough upper bounds of the largest temporaries of every rasterizer, the mesh is assumed to
+    cover about a quarter of the image.
+    """
+    if memory_budget is None:
+        return h
+    triangles_per_pixel = 4 * n_triangles / (h * w)
+    if rasterizer == 'dense':
+        # [pixels, triangles] coverage masks and depth buffer of a single image
+        pixel_bytes = 32 * n_triangles
+    elif rasterizer == 'tiled':
+        # padded [pixels, triangles per tile] coverage test
+        pixel_bytes = b * 8 * max(1., triangles_per_pixel * tile_size ** 2)
+    else:
+        # fragments of every triangle overlapping the pixel
+        pixel_bytes = b * 64 * max(1., triangles_per_pixel)
+    return int(max(1, min(h, memory_budget // (pixel_bytes * w))))
+
+
+@torch.no_grad()
+def rasterize(vertices, triangles, b, h, w, rasterizer='dense', band_height=None):
+    """
+    Returns a [b, h, w] map with the index of the visible triangle of each pixel (-1 for background).
+    Visibility has no gradient, so it is computed without autograd.
+    Coverage and depth ordering always run in fp32, under autocast fp16 depths would tie between neighbouring triangles.
+    """
+    vertices = vertices.type(torch.float32)
+    with torch.autocast(vertices.device.type, enabled=False):
+        tri_depth = (vertices[:, 2, triangles[0, :]] + vertices[:, 2, triangles[1, :]] + vertices[:, 2, triangles[2, :]]) / 3.
+        if band_height is None or band_height >= h:
+            return rasterizers[rasterizer](vertices, triangles, tri_depth, b, h, w)
+
+        # rasterize horizontal bands of the image to bound the memory, each band only keeps the triangles overlapping it
+        pix_to_face = []
+        for top in range(0, h, band_height):
+            pix_to_face.append(rasterizers[rasterizer](vertices, triangles, tri_depth, b, min(band_height, h - top), w,
+                                                       top=top))
+        return torch.cat(pix_to_face, dim=1)
+
+
+class RenderTexture(torch.autograd.Function):
+    """
+    Renders a flattened [b, c, uv_pixels] texture through the pixel to triangle map, the color of a triangle is the
+    mean of the texels of its face_ind vertices.
+    Only pix_to_face is saved for backward, which scatters the pixel gradients to the triangles, their vertices and
+    finally the texels.
+    """
+    @staticmethod
+    def forward(ctx, texture, face_ind, triangles, pix_to_face):
+        colors = texture[..., face_ind]
+        tri_tex = (colors[:, :, triangles[0, :]] + colors[:, :, triangles[1, :]] + colors[:, :, triangles[2, :]]) / 3.
+        image, _ = shade_pix_to_face(pix_to_face, tri_tex)
+        ctx.save_for_backward(face_ind, triangles, pix_to_face)
+        ctx.texture_shape = texture.shape
+        return image
+
+    @staticmethod
+    def backward(ctx, grad_image):
+        face_ind, triangles, pix_to_face = ctx.saved_tensors
+        b, c = grad_image.shape[:2]
+        pix_to_face = pix_to_face.view(b, 1, -1)
+        grad_pixels = torch.where(pix_to_face >= 0, grad_image.reshape(b, c, -1), torch.zeros(1, device=grad_image.device))
+        grad_tri = grad_image.new_zeros((b, c, triangles.shape[1]))
+        grad_tri.scatter_add_(2, pix_to_face.clamp(min=0).expand(-1, c, -1), grad_pixels)
+        grad_tri = grad_tri / 3.
+        grad_colors = grad_image.new_zeros((b, c, face_ind.shape[0]))
+        for corner in range(3):
+            grad_colors.index_add_(2, triangles[corner, :], grad_tri)
+        grad_texture = grad_image.new_zeros(ctx.texture_shape)
+        grad_texture.index_add_(2, face_ind, grad_colors)
+        return grad_texture, None, None, None
+
+
+def render_texture_pt(vertices, colors, triangles, device, b, h, w, rasterizer='dense', band_height=None):
+    pix_to_face = rasterize(vertices, triangles, b, h, w, rasterizer, band_height)
+    _, tri_tex = get_triangle_attributes(vertices, colors, triangles)
+    return shade_pix_to_face(pix_to_face, tri_tex)
+
 
-    return image, face_mask
+def render_uv_texture_pt(vertices, texture, face_ind, triangles, b, h, w, rasterizer='dense', band_height=None):
+    pix_to_face = rasterize(vertices, triangles, b, h, w, rasterizer, band_height)
+    image = RenderTexture.apply(texture.reshape(b, texture.shape[1], -1), face_ind, triangles, pix_to_face)
+    return image, (pix_to_face >= 0).unsqueeze(1).type(image.dtype)
@@ -0,0 +1,124 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+columns = {'image': np.int32, 'identity': np.int32, 'embedder': np.int16, 'mask': np.int16, 'target_type': np.int16,
+           'similarity': np.float32}
+
+
+class SimilarityStore:
+    """
+    Columnar store of the per image similarities of a test run, one raw binary file per column (image, identity,
+    embedder, mask, target_type, similarity) in store_dir. Rows are buffered and appended in bulk once per batch,
+    reading memory maps the columns and aggregates them with vectorized group-bys.
+    Image names are kept in images.txt, the embedder, mask and target type columns hold indices into the name lists
+    saved in meta.json.
+    """
+    def __init__(self, store_dir, embedder_names=None, mask_names=None, target_types=None):
+        self.store_dir = store_dir
+        self.buffer = {name: [] for name in columns.keys()}
+        self.buffered_img_names = []
+        meta_path = os.path.join(store_dir, 'meta.json')
+        if embedder_names is None:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            embedder_names, mask_names, target_types = meta['embedder_names'], meta['mask_names'], meta['target_types']
+            self.num_images = meta['num_images']
+        else:
+            Path(store_dir).mkdir(parents=True, exist_ok=True)
+            for name in list(columns.keys()) + ['images']:
+                open(self.get_path(name), 'w').close()
+            self.num_images = 0
+        self.embedder_names = list(embedder_names)
+        self.mask_names = list(mask_names)
+        self.target_types = list(target_types)
+        self.write_meta()
+
+    def get_path(self, name):
+        return os.path.join(self.store_dir, name + ('.txt' if name == 'images' else '.bin'))
+
+    def write_meta(self):
+        meta = {'embedder_names': self.embedder_names, 'mask_names': self.mask_names,
+                'target_types': self.target_types, 'num_images': self.num_images,
+                'dtypes': {name: np.dtype(dtype).name for name, dtype in columns.items()}}
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def add_images(self, img_names):
+        """
+        Registers the images of a batch, returns their indices for the image column.
+        """
+        self.buffered_img_names.extend(img_names)
+        start = self.num_images + len(self.buffered_img_names) - len(img_names)
+        return np.arange(start, start + len(img_names), dtype=columns['image'])
+
+    def append(self, image_ids, cls_ids, emb_name, target_type, similarities):
+        """
+        Buffers the similarities of a batch for one embedder and target type, similarities is [masks, b].
+        """
+        similarities = np.asarray(similarities, dtype=columns['similarity'])
+        num_masks, b = similarities.shape
+        self.buffer['image'].append(np.tile(image_ids, num_masks))
+        self.buffer['identity'].append(np.tile(np.asarray(cls_ids, dtype=columns['identity']), num_masks))
+        self.buffer['embedder'].append(np.full(num_masks * b, self.embedder_names.index(emb_name), dtype=columns['embedder']))
+        self.buffer['mask'].append(np.repeat(np.arange(num_masks, dtype=columns['mask']), b))
+        self.buffer['target_type'].append(np.full(num_masks * b, self.target_types.index(target_type), dtype=columns['target_type']))
+        self.buffer['similarity'].append(similarities.reshape(-1))
+
+    def flush(self):
+        for name, chunks in self.buffer.items():
+            if len(chunks) == 0:
+                continue
+            with open(self.get_path(name), 'ab') as f:
+                np.concatenate(chunks).astype(columns[name], copy=False).tofile(f)
+            chunks.clear()
+        if len(self.buffered_img_names) > 0:
+            with open(self.get_path('images'), 'a') as f:
+                f.write(''.join(img_name + '\n' for img_name in self.buffered_img_names))
+            self.num_images += len(self.buffered_img_names)
+            self.buffered_img_names = []
+        self.write_meta()
+
+    def load(self):
+        """
+        Returns a dict of memory mapped columns.
+        """
+        loaded = {}
+        for name, dtype in columns.items():
+            path = self.get_path(name)
+            loaded[name] = np.memmap(path, dtype=dtype, mode='r') if os.path.getsize(path) > 0 else np.empty(0, dtype)
+        return loaded
+
+    def get_image_names(self):
+        with open(self.get_path('images'), 'r') as f:
+            return f.read().splitlines()
+
+    def get_similarities(self, target_type, num_identities=None, by_person=False):
+        """
+        Returns {emb_name: [similarities of every mask]}, the similarities of all the images in write order or, if
+        by_person, the average similarity of every identity (nan for identities without images).
+        """
+        table = self.load()
+        rows = table['target_type'] == self.target_types.index(target_type)
+        embedder, mask, similarity = table['embedder'][rows], table['mask'][rows], table['similarity'][rows]
+        num_masks = len(self.mask_names)
+        if not by_person:
+            group = embedder.astype(np.int64) * num_masks + mask
+            order = np.argsort(group, kind='stable')
+            bounds = np.searchsorted(group[order], np.arange(len(self.embedder_names) * num_masks + 1))
+            sorted_similarity = similarity[order]
+            groups = [sorted_similarity[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+        else:
+            identity = table['identity'][rows]
+            if num_identities is None:
+                num_identities = int(identity.max()) + 1 if len(identity) > 0 else 0
+            group = (embedder.astype(np.int64) * num_masks + mask) * num_identities + identity
+            size = len(self.embedder_names) * num_masks * num_identities
+            sums = np.bincount(group, weights=similarity, minlength=size)
+            counts = np.bincount(group, minlength=size)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                groups = (sums / counts).reshape(-1, num_identities)
+        return {emb_name: [groups[i * num_masks + j].tolist() for j in range(num_masks)]
+                for i, emb_name in enumerate(self.embedder_names)}
@@ -4,7 +4,11 @@ import os
 import warnings
 import utils
 import torch
-from nn_modules import LandmarkExtractor, FaceXZooProjector
+import torch.nn.functional as F
+from nn_modules import LandmarkExtractor, FaceXZooProjector, EmbedderEnsemble
+from similarity_store import SimilarityStore
+from metrics import ScoreAccumulator
+from verification import VerificationAccumulator
 
 from config import patch_config_types
 from torchvision import transforms
@@ -12,11 +16,8 @@ from PIL import Image
 import numpy as np
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import label_binarize
 import matplotlib
 from pathlib import Path
-import pickle
 import seaborn as sns
 import pandas as pd
 matplotlib.use('Agg')
@@ -32,23 +33,31 @@ class Evaluator:
         self.best_patch = best_patch
         face_landmark_detector = utils.get_landmark_detector(self.config, device)
         self.location_extractor = LandmarkExtractor(device, face_landmark_detector, self.config.img_size).to(device)
-        self.fxz_projector = FaceXZooProjector(device, self.config.img_size, self.config.patch_size).to(device)
+        self.fxz_projector = FaceXZooProjector(device, self.config.img_size, self.config.patch_size,
+                                               rasterizer=self.config.rasterizer,
+                                               cull_mask_region=self.config.cull_mask_region,
+                                               mesh_lod=self.config.mesh_lod,
+                                               memory_budget=self.config.render_memory_budget).to(device)
         self.transform = transforms.Compose([transforms.Resize(self.config.patch_size), transforms.ToTensor()])
         self.embedders = utils.load_embedder(self.config.test_embedder_names, device=device)
+        self.embedder_ensemble = EmbedderEnsemble(self.embedders, self.config.embedder_memory_budget)
         emb_loaders, self.test_loaders = utils.get_test_loaders(self.config, self.config.test_celeb_lab.keys())
 
         self.target_embedding_w_mask, self.target_embedding_wo_mask = {}, {}
         for dataset_name, loader in emb_loaders.items():
-            self.target_embedding_w_mask[dataset_name] = utils.get_person_embedding(self.config, loader, self.config.test_celeb_lab_mapper[dataset_name], self.location_extractor,
-                                                                                    self.fxz_projector, self.embedders, device, include_others=True)
-            self.target_embedding_wo_mask[dataset_name] = utils.get_person_embedding(self.config, loader, self.config.test_celeb_lab_mapper[dataset_name], self.location_extractor,
-                                                                                     self.fxz_projector, self.embedders, device, include_others=False)
+            person_embeddings = utils.get_person_embeddings(self.config, loader, self.config.test_celeb_lab_mapper[dataset_name], self.location_extractor,
+                                                            self.fxz_projector, self.embedders, device, include_others=(True, False),
+                                                            embedder_ensemble=self.embedder_ensemble)
+            self.target_embedding_w_mask[dataset_name] = person_embeddings[True]
+            self.target_embedding_wo_mask[dataset_name] = person_embeddings[False]
 
         self.random_mask_t = utils.load_mask(self.config, self.config.random_mask_path, device)
         self.blue_mask_t = utils.load_mask(self.config, self.config.blue_mask_path, device)
         self.face1_mask_t = utils.load_mask(self.config, self.config.face1_mask_path, device)
         self.face3_mask_t = utils.load_mask(self.config, self.config.face3_mask_path, device)
         self.mask_names = ['Clean', 'Adv', 'Random', 'Blue', 'Face1', 'Face3']
+        self.score_accumulators = {}
+        self.verification_accumulators = {}
 
         Path(self.config.current_dir).mkdir(parents=True, exist_ok=True)
         utils.save_class_to_file(self.config, self.config.current_dir)
@@ -62,6 +71,12 @@ class Evaluator:
             self.calc_similarity_statistics(similarities_target_without_mask_by_person, target_type='without', dataset_name=dataset_name, by_person=True)
             self.plot_sim_box(similarities_target_with_mask_by_person, target_type='with', dataset_name=dataset_name, by_person=True)
             self.plot_sim_box(similarities_target_without_mask_by_person, target_type='without', dataset_name=dataset_name, by_person=True)
+            self.calc_average_precision(target_type='with', dataset_name=dataset_name)
+            self.calc_average_precision(target_type='without', dataset_name=dataset_name)
+            if self.config.gallery_index_type != 'exact':
+                self.calc_search_statistics(dataset_name)
+            if dataset_name in self.verification_accumulators:
+                self.calc_verification(dataset_name)
 
     @torch.no_grad()
     def calc_overall_similarity(self):
@@ -70,27 +85,39 @@ class Evaluator:
 
             adv_patch = self.best_patch.to(device)
             for dataset_name, loader in self.test_loaders.items():
-                df_with_mask = pd.DataFrame(columns=['y_true', 'y_pred'])
-                df_without_mask = pd.DataFrame(columns=['y_true', 'y_pred'])
+                store = SimilarityStore(self.get_similarity_store_dir(dataset_name), self.config.test_embedder_names,
+                                        self.mask_names, ['with_mask', 'without_mask'])
+                self.score_accumulators[dataset_name] = {
+                    'with_mask': self.get_score_accumulator(self.target_embedding_w_mask[dataset_name]),
+                    'without_mask': self.get_score_accumulator(self.target_embedding_wo_mask[dataset_name])}
+                if len(self.config.verification_far_targets) > 0:
+                    self.verification_accumulators[dataset_name] = VerificationAccumulator(self.config.test_embedder_names, self.mask_names)
                 for img_batch, img_names, cls_id in tqdm(loader):
                     img_batch = img_batch.to(device)
                     cls_id = cls_id.to(device).type(torch.int32)
 
-                    # Apply different types of masks
-                    img_batch_applied = self.apply_all_masks(img_batch, adv_patch)
+                    with utils.get_autocast(self.config, device):
+                        # Apply different types of masks
+                        img_batch_applied = self.apply_all_masks(img_batch, adv_patch)
 
-                    # Get embedding
-                    all_embeddings = self.get_all_embeddings(img_batch, img_batch_applied)
+                        # Get embedding
+                        all_embeddings = self.get_all_embeddings(img_batch, img_batch_applied)
 
-                    self.calc_all_similarity(all_embeddings, img_names, cls_id, 'with_mask', dataset_name)
-                    self.calc_all_similarity(all_embeddings, img_names, cls_id, 'without_mask', dataset_name)
+                    image_ids = store.add_images(img_names)
+                    self.calc_all_similarity(all_embeddings, image_ids, cls_id, 'with_mask', dataset_name, store)
+                    self.calc_all_similarity(all_embeddings, image_ids, cls_id, 'without_mask', dataset_name, store)
+                    store.flush()
 
-                    df_with_mask = df_with_mask.append(self.calc_preds(cls_id, all_embeddings, target_type='with_mask', dataset_name=dataset_name))
-                    df_without_mask = df_without_mask.append(self.calc_preds(cls_id, all_embeddings, target_type='without_mask', dataset_name=dataset_name))
+                    for score_accumulator in self.score_accumulators[dataset_name].values():
+                        score_accumulator.update(all_embeddings, cls_id)
+                    if dataset_name in self.verification_accumulators:
+                        self.verification_accumulators[dataset_name].update(all_embeddings, cls_id, img_names)
 
                 Path(os.path.join(self.config.current_dir, 'saved_preds', dataset_name)).mkdir(parents=True, exist_ok=True)
-                df_with_mask.to_csv(os.path.join(self.config.current_dir, 'saved_preds', dataset_name, 'preds_with_mask.csv'), index=False)
-                df_without_mask.to_csv(os.path.join(self.config.current_dir, 'saved_preds', dataset_name, 'preds_without_mask.csv'), index=False)
+                for target_type, score_accumulator in self.score_accumulators[dataset_name].items():
+                    preds = score_accumulator.to_dataframe()
+                    if preds is not None:
+                        preds.to_csv(os.path.join(self.config.current_dir, 'saved_preds', dataset_name, 'preds_' + target_type + '.csv'), index=False)
 
     def plot_sim_box(self, similarities, target_type, dataset_name, by_person=False):
         Path(os.path.join(self.config.current_dir, 'final_results', 'sim-boxes', dataset_name, target_type)).mkdir(parents=True, exist_ok=True)
@@ -107,119 +134,134 @@ class Evaluator:
             plt.savefig(os.path.join(self.config.current_dir, 'final_results', 'sim-boxes', dataset_name, target_type, avg_type + '_' + emb_name + '.png'))
             plt.close()
 
-    def write_similarities_to_disk(self, sims, img_names, cls_ids, sim_type, emb_name, dataset_name):
-        Path(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name)).mkdir(parents=True, exist_ok=True)
-        for i, lab in self.config.test_celeb_lab_mapper[dataset_name].items():
-            Path(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name, lab)).mkdir(parents=True, exist_ok=True)
-            for similarity, mask_name in zip(sims, self.mask_names):
-                sim = similarity[cls_ids.cpu().numpy() == i].tolist()
-                sim = {img_name: s for img_name, s in zip(img_names, sim)}
-                with open(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name, lab, sim_type + '_' + mask_name + '.pickle'), 'ab') as f:
-                    pickle.dump(sim, f)
-        for similarity, mask_name in zip(sims, self.mask_names):
-            sim = {img_name: s for img_name, s in zip(img_names, similarity.tolist())}
-            with open(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name, sim_type + '_' + mask_name + '.pickle'), 'ab') as f:
-                pickle.dump(sim, f)
+    def get_score_accumulator(self, target_embedding):
+        return ScoreAccumulator(target_embedding, self.mask_names, num_bins=self.config.ap_num_bins,
+                                dtype=self.config.gallery_dtype, index_type=self.config.gallery_index_type,
+                                top_k=self.config.gallery_top_k,
+                                dense_max_identities=self.config.gallery_dense_max_identities)
+
+    def get_similarity_store_dir(self, dataset_name):
+        return os.path.join(self.config.current_dir, 'saved_similarities', dataset_name)
 
     def apply_all_masks(self, img_batch, adv_patch):
-        img_batch_applied_adv = utils.apply_mask(self.location_extractor,
-                                                 self.fxz_projector, img_batch, adv_patch)
-        img_batch_applied_random = utils.apply_mask(self.location_extractor,
-                                                    self.fxz_projector, img_batch,
-                                                    self.random_mask_t)
-        img_batch_applied_blue = utils.apply_mask(self.location_extractor,
-                                                  self.fxz_projector, img_batch,
-                                                  self.blue_mask_t[:, :3],
-                                                  self.blue_mask_t[:, 3], is_3d=True)
-        img_batch_applied_face1 = utils.apply_mask(self.location_extractor,
-                                                   self.fxz_projector, img_batch,
-                                                   self.face1_mask_t[:, :3],
-                                                   self.face1_mask_t[:, 3], is_3d=True)
-        img_batch_applied_face3 = utils.apply_mask(self.location_extractor,
-                                                   self.fxz_projector, img_batch,
-                                                   self.face3_mask_t[:, :3],
-                                                   self.face3_mask_t[:, 3], is_3d=True)
+        textures = [dict(adv_patch=adv_patch),
+                    dict(adv_patch=self.random_mask_t),
+                    dict(adv_patch=self.blue_mask_t[:, :3], uv_mask_src=self.blue_mask_t[:, 3], is_3d=True,
+                         mask_key=self.config.blue_mask_path),
+                    dict(adv_patch=self.face1_mask_t[:, :3], uv_mask_src=self.face1_mask_t[:, 3], is_3d=True,
+                         mask_key=self.config.face1_mask_path),
+                    dict(adv_patch=self.face3_mask_t[:, :3], uv_mask_src=self.face3_mask_t[:, 3], is_3d=True,
+                         mask_key=self.config.face3_mask_path)]
+        img_batch_applied_adv, img_batch_applied_random, img_batch_applied_blue, img_batch_applied_face1, img_batch_applied_face3 = \
+            utils.apply_masks(self.location_extractor, self.fxz_projector, img_batch, textures)
 
         return img_batch_applied_adv, img_batch_applied_random, img_batch_applied_blue, img_batch_applied_face1, img_batch_applied_face3
 
     def get_all_embeddings(self, img_batch, img_batch_applied_masks):
+        """
+        Embeds the clean and all the masked batches in a single pass per embedder (chunked by embedder_memory_budget),
+        returns per embedder a list of [b, emb_size] float32 device tensors in the order of mask_names.
+        """
+        all_batches = torch.cat([img_batch] + [batch.to(device) for batch in img_batch_applied_masks])
         batch_embs = {}
-        for emb_name, emb_model in self.embedders.items():
-            batch_embs[emb_name] = [emb_model(img_batch.to(device)).cpu().numpy()]
-            for img_batch_applied_mask in img_batch_applied_masks:
-                batch_embs[emb_name].append(emb_model(img_batch_applied_mask.to(device)).cpu().numpy())
+        for emb_name, emb in self.embedder_ensemble(all_batches).items():
+            batch_embs[emb_name] = list(emb.type(torch.float32).split(img_batch.shape[0]))
         return batch_embs
 
-    def calc_all_similarity(self, all_embeddings, img_names, cls_id, target_type, dataset_name):
+    def calc_all_similarity(self, all_embeddings, image_ids, cls_id, target_type, dataset_name, store):
         for emb_name in self.config.test_embedder_names:
             target = self.target_embedding_w_mask[dataset_name][emb_name] if target_type == 'with_mask' else self.target_embedding_wo_mask[dataset_name][emb_name]
-            target_embedding = torch.index_select(target, index=cls_id, dim=0).cpu().numpy().squeeze(-2)
+            target_embedding = torch.index_select(target, index=cls_id, dim=0).squeeze(-2)
             sims = []
             for emb in all_embeddings[emb_name]:
-                sims.append(np.diag(cosine_similarity(emb, target_embedding)))
-            self.write_similarities_to_disk(sims, img_names, cls_id, sim_type=target_type, emb_name=emb_name, dataset_name=dataset_name)
+                sims.append(F.cosine_similarity(emb, target_embedding))
+            store.append(image_ids, cls_id.cpu().numpy(), emb_name, target_type, torch.stack(sims).cpu().numpy())
 
     def get_final_similarity_from_disk(self, sim_type, dataset_name, by_person=False):
-        sims = {}
+        store = SimilarityStore(self.get_similarity_store_dir(dataset_name))
+        return store.get_similarities(sim_type, num_identities=len(self.config.test_celeb_lab_mapper[dataset_name]),
+                                      by_person=by_person)
+
+    def calc_average_precision(self, target_type, dataset_name):
+        score_accumulator = self.score_accumulators[dataset_name][target_type + '_mask']
+        labs = [self.config.test_celeb_lab_mapper[dataset_name][i] for i in range(score_accumulator.num_classes)]
+        micro_rows, macro_rows, per_class_rows = [], [], []
+        pr_curves_dir = os.path.join(self.config.current_dir, 'final_results', 'pr-curves', dataset_name, target_type)
+        Path(pr_curves_dir).mkdir(parents=True, exist_ok=True)
         for emb_name in self.config.test_embedder_names:
-            sims[emb_name] = []
-            for i, mask_name in enumerate(self.mask_names):
-                if not by_person:
-                    with open(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name, sim_type + '_' + mask_name + '.pickle'), 'rb') as f:
-                        sims[emb_name].append([])
-                        while True:
-                            try:
-                                data = pickle.load(f).values()
-                                sims[emb_name][i].extend(list(data))
-                            except EOFError:
-                                break
-                else:
-                    sims[emb_name].append([])
-                    for lab in self.config.test_celeb_lab[dataset_name]:
-                        with open(os.path.join(self.config.current_dir, 'saved_similarities', dataset_name, emb_name, lab, sim_type + '_' + mask_name + '.pickle'), 'rb') as f:
-                            person_sims = []
-                            while True:
-                                try:
-                                    data = pickle.load(f).values()
-                                    person_sims.extend(list(data))
-                                except EOFError:
-                                    break
-                            person_avg_sim = sum(person_sims) / len(person_sims)
-                            sims[emb_name][i].append(person_avg_sim)
-        return sims
-
-
-    def calc_preds(self, cls_id, all_embeddings, target_type, dataset_name):
-        df = pd.DataFrame(columns=['emb_name', 'mask_name', 'y_true', 'y_pred'])
-        class_labels = list(range(0, len(self.config.test_celeb_lab_mapper[dataset_name])))
-        y_true = label_binarize(cls_id.cpu().numpy(), classes=class_labels)
-        y_true = [lab.tolist() for lab in y_true]
+            micro_row, macro_row = [emb_name], [emb_name]
+            for mask_name in self.mask_names:
+                per_class, micro, macro = score_accumulator.get_average_precision_summary(emb_name, mask_name)
+                micro_row.append(round(micro.item(), 3))
+                macro_row.append(round(macro.item(), 3))
+                per_class_rows.append([emb_name, mask_name] + np.round(per_class.cpu().numpy(), decimals=3).tolist())
+                precision, recall = score_accumulator.precision_recall_curve(emb_name, mask_name)
+                plt.plot(recall.cpu().numpy(), precision.cpu().numpy(), label=f'{mask_name} (AP {micro.item():.3f})')
+            micro_rows.append(micro_row)
+            macro_rows.append(macro_row)
+            plt.xlabel('Recall')
+            plt.ylabel('Precision')
+            plt.title('Micro Averaged Precision Recall Curves')
+            plt.legend()
+            plt.savefig(os.path.join(pr_curves_dir, emb_name + '.png'))
+            plt.close()
+
+        stats_dir = os.path.join(self.config.current_dir, 'final_results', 'stats', 'average_precision', dataset_name, target_type)
+        Path(stats_dir).mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(micro_rows, columns=['emb_name'] + self.mask_names).to_csv(os.path.join(stats_dir, 'micro_ap_df.csv'), index=False)
+        pd.DataFrame(macro_rows, columns=['emb_name'] + self.mask_names).to_csv(os.path.join(stats_dir, 'macro_ap_df.csv'), index=False)
+        pd.DataFrame(per_class_rows, columns=['emb_name', 'mask_name'] + labs).to_csv(os.path.join(stats_dir, 'per_class_ap_df.csv'), index=False)
+
+    def calc_search_statistics(self, dataset_name):
+        rows = []
+        for target_type, score_accumulator in self.score_accumulators[dataset_name].items():
+            for emb_name in self.config.test_embedder_names:
+                for mask_name in self.mask_names:
+                    recall, throughput, exact_throughput = score_accumulator.get_search_stats(emb_name, mask_name)
+                    rows.append([target_type, emb_name, mask_name, round(recall, 4), round(throughput), round(exact_throughput)])
+        stats_dir = os.path.join(self.config.current_dir, 'final_results', 'stats', 'gallery_index', dataset_name)
+        Path(stats_dir).mkdir(parents=True, exist_ok=True)
+        columns = ['target_type', 'emb_name', 'mask_name', 'recall@' + str(self.config.gallery_top_k),
+                   self.config.gallery_index_type + '_probes_per_sec', 'exact_probes_per_sec']
+        pd.DataFrame(rows, columns=columns).to_csv(os.path.join(stats_dir, 'search_df.csv'), index=False)
+
+    def calc_verification(self, dataset_name):
+        histograms = self.verification_accumulators[dataset_name].evaluate(block_size=self.config.verification_block_size,
+                                                                          pairs_path=self.config.verification_pairs_path,
+                                                                          device=device)
+        rows = []
+        roc_dir = os.path.join(self.config.current_dir, 'final_results', 'roc-curves', dataset_name)
+        Path(roc_dir).mkdir(parents=True, exist_ok=True)
         for emb_name in self.config.test_embedder_names:
-            target_embedding = self.target_embedding_w_mask[dataset_name][emb_name] \
-                if target_type == 'with_mask' else self.target_embedding_wo_mask[dataset_name][emb_name]
-            target_embedding = target_embedding.cpu().numpy().squeeze(-2)
-            for i, mask_name in enumerate(self.mask_names):
-                emb = all_embeddings[emb_name][i]
-                cos_sim = cosine_similarity(emb, target_embedding)
-                y_pred = [lab.tolist() for lab in cos_sim]
-                new_rows = pd.DataFrame({
-                    'emb_name': [emb_name] * len(y_true),
-                    'mask_name': [mask_name] * len(y_true),
-                    'y_true': y_true,
-                    'y_pred': y_pred
-                })
-                df = df.append(new_rows, ignore_index=True)
-        return df
+            for mask_name in self.mask_names:
+                histogram = histograms[(emb_name, mask_name)]
+                rows.append([emb_name, mask_name, len(histogram)] +
+                            [round(histogram.tar_at_far(far), 4) for far in self.config.verification_far_targets])
+                far, tar = histogram.roc()
+                plt.plot(far.numpy(), tar.numpy(), label=mask_name)
+            plt.xscale('log')
+            plt.xlabel('False Accept Rate')
+            plt.ylabel('True Accept Rate')
+            plt.title('Verification ROC (clean references)')
+            plt.legend()
+            plt.savefig(os.path.join(roc_dir, emb_name + '.png'))
+            plt.close()
+
+        stats_dir = os.path.join(self.config.current_dir, 'final_results', 'stats', 'verification', dataset_name)
+        Path(stats_dir).mkdir(parents=True, exist_ok=True)
+        columns = ['emb_name', 'mask_name', 'pairs'] + ['tar@far=' + str(far) for far in self.config.verification_far_targets]
+        pd.DataFrame(rows, columns=columns).to_csv(os.path.join(stats_dir, 'tar_at_far_df.csv'), index=False)
 
     def calc_similarity_statistics(self, sim_dict, target_type, dataset_name, by_person=False):
-        df_mean = pd.DataFrame(columns=['emb_name'] + self.mask_names)
-        df_std = pd.DataFrame(columns=['emb_name'] + self.mask_names)
+        mean_rows, std_rows = [], []
         for emb_name, sim_values in sim_dict.items():
             sim_values = np.array([np.array(lst) for lst in sim_values])
             sim_mean = np.round(sim_values.mean(axis=1), decimals=3)
             sim_std = np.round(sim_values.std(axis=1), decimals=3)
-            df_mean = df_mean.append(pd.Series([emb_name] + sim_mean.tolist(), index=df_mean.columns), ignore_index=True)
-            df_std = df_std.append(pd.Series([emb_name] + sim_std.tolist(), index=df_std.columns), ignore_index=True)
+            mean_rows.append([emb_name] + sim_mean.tolist())
+            std_rows.append([emb_name] + sim_std.tolist())
+        df_mean = pd.DataFrame(mean_rows, columns=['emb_name'] + self.mask_names)
+        df_std = pd.DataFrame(std_rows, columns=['emb_name'] + self.mask_names)
 
         avg_type = 'person' if by_person else 'image'
         Path(os.path.join(self.config.current_dir, 'final_results', 'stats', 'similarity', dataset_name, target_type)).mkdir(parents=True, exist_ok=True)
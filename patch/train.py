@@ -1,6 +1,7 @@
 import sys
 import os
     
+import copy
 import random
 from pathlib import Path
 import pickle
@@ -10,14 +11,18 @@ import numpy as np
 from tqdm import tqdm
 from torchvision import transforms
 import torch.optim as optim
+from torch.utils.data import DataLoader
 import matplotlib.pyplot as plt
-from PIL import Image
 
 import utils
 import losses
 from config import patch_config_types
-from nn_modules import LandmarkExtractor, FaceXZooProjector, TotalVariation
+from landmark_detection.face_alignment.face_alignment import FaceAlignment
+from nn_modules import LandmarkExtractor, FaceXZooProjector, TotalVariation, EmbedderEnsemble
 from utils import load_embedder, EarlyStopping, get_patch
+from geometry_cache import GeometryCache, get_weights_hash
+from assets import get_asset
+from gallery_index import GalleryIndex
 
 
 import warnings
@@ -40,6 +45,20 @@ def set_random_seed(seed_value):
         torch.backends.cudnn.benchmark = False
 
 
+def create_output_folders(config):
+    Path('/'.join(config.current_dir.split('/')[:2])).mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir).mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/final_results/sim-boxes').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/final_results/pr-curves').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/final_results/stats/similarity').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/final_results/stats/average_precision').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/saved_preds').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/saved_patches').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/saved_similarities').mkdir(parents=True, exist_ok=True)
+    Path(config.current_dir + '/losses').mkdir(parents=True, exist_ok=True)
+    utils.save_class_to_file(config, config.current_dir)
+
+
 class AdversarialMask:
     def __init__(self, config):
         self.config = config
@@ -48,10 +67,16 @@ class AdversarialMask:
         self.train_no_aug_loader, self.train_loader = utils.get_train_loaders(self.config)
 
         self.embedders = load_embedder(self.config.train_embedder_names, device)
+        self.embedder_ensemble = EmbedderEnsemble(self.embedders, self.config.embedder_memory_budget)
 
         face_landmark_detector = utils.get_landmark_detector(self.config, device)
         self.location_extractor = LandmarkExtractor(device, face_landmark_detector, self.config.img_size).to(device)
-        self.fxz_projector = FaceXZooProjector(device, self.config.img_size, self.config.patch_size).to(device)
+        self.fxz_projector = FaceXZooProjector(device, self.config.img_size, self.config.patch_size,
+                                               rasterizer=self.config.rasterizer,
+                                               cull_mask_region=self.config.cull_mask_region,
+                                               mesh_lod=self.config.mesh_lod,
+                                               memory_budget=self.config.render_memory_budget).to(device)
+        self.geometry_cache = self.get_geometry_cache()
         self.total_variation = TotalVariation(device).to(device)
         self.dist_loss = losses.get_loss(self.config)
 
@@ -62,27 +87,49 @@ class AdversarialMask:
         self.val_losses = []
 
         self.create_folders()
-        utils.save_class_to_file(self.config, self.config.current_dir)
         self.target_embedding = utils.get_person_embedding(self.config, self.train_no_aug_loader, self.config.celeb_lab_mapper, self.location_extractor,
-                                                           self.fxz_projector, self.embedders, device)
+                                                           self.fxz_projector, self.embedders, device,
+                                                           embedder_ensemble=self.embedder_ensemble)
+        self.target_index = {emb_name: GalleryIndex(target_embedding, dtype=self.config.gallery_dtype, device=device)
+                             for emb_name, target_embedding in self.target_embedding.items()}
         self.best_patch = None
 
+    def get_geometry_cache(self):
+        if self.config.geometry_cache_dir is None:
+            return None
+        # the geometry also depends on the preprocessing of the images it was computed on
+        preprocessing = [self.config.landmark_detector_type, str(tuple(self.config.img_size)),
+                         repr(self.train_no_aug_loader.dataset.transform)]
+        weights_hash = get_weights_hash(self.get_geometry_modules(), extra='|'.join(preprocessing))
+        geometry_cache = GeometryCache(self.config.geometry_cache_dir, weights_hash,
+                                       capacity=len(self.train_no_aug_loader.dataset),
+                                       max_capacity=self.config.geometry_cache_max_images)
+        geometry_cache.fill(self.train_no_aug_loader, self.location_extractor, self.fxz_projector, device)
+        print(geometry_cache, flush=True)
+        return geometry_cache
+
+    def get_geometry_modules(self):
+        """
+        The modules producing the cached geometry, a FaceAlignment detector is a plain object so its networks are added
+        explicitly.
+        """
+        modules = [self.location_extractor, self.fxz_projector.prn.net]
+        face_align = self.location_extractor.face_align
+        if isinstance(face_align, FaceAlignment):
+            modules.append(face_align.face_alignment_net)
+            face_detector_net = getattr(face_align.face_detector, 'face_detector', None)
+            if isinstance(face_detector_net, torch.nn.Module):
+                modules.append(face_detector_net)
+        return modules
+
     def create_folders(self):
-        Path('/'.join(self.config.current_dir.split('/')[:2])).mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir).mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/final_results/sim-boxes').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/final_results/pr-curves').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/final_results/stats/similarity').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/final_results/stats/average_precision').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/saved_preds').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/saved_patches').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/saved_similarities').mkdir(parents=True, exist_ok=True)
-        Path(self.config.current_dir + '/losses').mkdir(parents=True, exist_ok=True)
+        create_output_folders(self.config)
 
     def train(self):
         adv_patch_cpu = utils.get_patch(self.config)
         optimizer = optim.Adam([adv_patch_cpu], lr=self.config.start_learning_rate, amsgrad=True)
         scheduler = self.config.scheduler_factory(optimizer)
+        scaler = utils.get_grad_scaler(self.config, device)
         early_stop = EarlyStopping(current_dir=self.config.current_dir, patience=self.config.es_patience, init_patch=adv_patch_cpu)
         epoch_length = len(self.train_loader)
         for epoch in range(self.config.epochs):
@@ -91,16 +138,17 @@ class AdversarialMask:
             tv_loss = 0.0
             progress_bar = tqdm(enumerate(self.train_loader), desc=f'Epoch {epoch}', total=epoch_length)
             prog_bar_desc = 'train-loss: {:.6}, dist-loss: {:.6}, tv-loss: {:.6}, lr: {:.6}'
-            for i_batch, (img_batch, _, cls_id) in progress_bar:
-                (b_loss, sep_loss), vars = self.forward_step(img_batch, adv_patch_cpu, cls_id)
+            for i_batch, (img_batch, img_names, cls_id) in progress_bar:
+                (b_loss, sep_loss), vars = self.forward_step(img_batch, adv_patch_cpu, cls_id, img_names)
 
                 train_loss += b_loss.item()
                 dist_loss += sep_loss[0].item()
                 tv_loss += sep_loss[1].item()
 
                 optimizer.zero_grad()
-                b_loss.backward()
-                optimizer.step()
+                scaler.scale(b_loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 adv_patch_cpu.data.clamp_(0, 1)
 
@@ -124,14 +172,16 @@ class AdversarialMask:
             scheduler.step(self.train_losses_epoch[-1])
         self.best_patch = early_stop.best_patch
         self.save_final_objects()
+        if self.geometry_cache is not None:
+            print(self.geometry_cache, flush=True)
         utils.plot_train_val_loss(self.config, self.train_losses_epoch, 'Epoch')
         utils.plot_train_val_loss(self.config, self.train_losses_iter, 'Iterations')
         utils.plot_separate_loss(self.config, self.train_losses_epoch, self.dist_losses, self.tv_losses)
 
     def loss_fn(self, patch_embs, tv_loss, cls_id):
         distance_loss = torch.empty(0, device=device)
-        for target_embedding, (emb_name, patch_emb) in zip(self.target_embedding.values(), patch_embs.items()):
-            target_embeddings = torch.index_select(target_embedding, index=cls_id, dim=0).squeeze(-2)
+        for emb_name, patch_emb in patch_embs.items():
+            target_embeddings = self.target_index[emb_name].get_vectors(cls_id)
             distance = self.dist_loss(patch_emb, target_embeddings)
             single_embedder_dist_loss = torch.mean(distance).unsqueeze(0)
             distance_loss = torch.cat([distance_loss, single_embedder_dist_loss], dim=0)
@@ -140,18 +190,24 @@ class AdversarialMask:
         total_loss = distance_loss + tv_loss
         return total_loss, [distance_loss, tv_loss]
 
-    def forward_step(self, img_batch, adv_patch_cpu, cls_id):
+    def forward_step(self, img_batch, adv_patch_cpu, cls_id, img_names=None):
         img_batch = img_batch.to(device)
         adv_patch = adv_patch_cpu.to(device)
         cls_id = cls_id.to(device)
 
-        preds = self.location_extractor(img_batch)
+        with utils.get_autocast(self.config, device):
+            geometry = None
+            if self.geometry_cache is not None and img_names is not None:
+                geometry = self.geometry_cache.get(img_names, device)
+            if geometry is not None:
+                preds, pos = geometry
+            else:
+                preds, pos = self.location_extractor(img_batch), None
 
-        img_batch_applied = self.fxz_projector(img_batch, preds, adv_patch, do_aug=self.config.mask_aug)
+            img_batch_applied = self.fxz_projector(img_batch, preds, adv_patch, do_aug=self.config.mask_aug, pos=pos)
 
-        patch_embs = {}
-        for embedder_name, emb_model in self.embedders.items():
-            patch_embs[embedder_name] = emb_model(img_batch_applied)
+            patch_embs = {embedder_name: patch_emb.type(torch.float32)
+                          for embedder_name, patch_emb in self.embedder_ensemble(img_batch_applied).items()}
 
         tv_loss = self.total_variation(adv_patch)
         loss = self.loss_fn(patch_embs, tv_loss, cls_id)
@@ -167,7 +223,7 @@ class AdversarialMask:
         self.tv_losses.append(tv_loss)
 
     def save_final_objects(self):
-        alpha = transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L'))
+        alpha = get_asset('../prnet/new_uv.png')
         final_patch = torch.cat([self.best_patch.squeeze(0), alpha])
         final_patch_img = transforms.ToPILImage()(final_patch.squeeze(0))
         final_patch_img.save(self.config.current_dir + '/final_results/final_patch.png', 'PNG')
@@ -185,6 +241,128 @@ class AdversarialMask:
             pickle.dump(self.tv_losses, fp)
 
 
+class MultiIdentityAdversarialMask(AdversarialMask):
+    """
+    Trains the targeted patches of several identities at once, every image is projected with the patch of its own
+    identity so all identities share the batched landmark, PRNet, rendering and embedder passes.
+    Each identity keeps its own optimizer, scheduler, early stopping and output folder (the current_dir of its config).
+    """
+    def __init__(self, configs):
+        self.configs = configs
+        super(MultiIdentityAdversarialMask, self).__init__(self.get_combined_config(configs))
+        self.identities = [self.get_identity(config) for config in configs]
+
+    @staticmethod
+    def get_combined_config(configs):
+        config = copy.deepcopy(configs[0])
+        config.set_attribute('celeb_lab', [identity_config.celeb_lab[0] for identity_config in configs])
+        config.set_attribute('celeb_lab_mapper', {i: lab for i, lab in enumerate(config.celeb_lab)})
+        if hasattr(config, 'update_test_celeb_lab'):
+            config.update_test_celeb_lab()
+        return config
+
+    def get_identity(self, config):
+        identity = copy.copy(self)
+        identity.config = config
+        identity.train_losses_epoch = []
+        identity.train_losses_iter = []
+        identity.dist_losses = []
+        identity.tv_losses = []
+        identity.val_losses = []
+        identity.best_patch = None
+        return identity
+
+    def create_folders(self):
+        for config in self.configs:
+            create_output_folders(config)
+
+    def get_identity_batches(self, active):
+        """
+        Batches with train_batch_size images of every active identity, so each identity gets as many steps per
+        epoch as when it is trained alone.
+        """
+        dataset = self.train_loader.dataset
+        indices = {i: [] for i in active}
+        for idx, img_name in enumerate(dataset.img_names):
+            i = dataset.celeb_lab_mapper[img_name.split(os.path.sep)[-2]]
+            if i in indices:
+                indices[i].append(idx)
+        batch_size = self.config.train_batch_size
+        steps = max(-(-len(identity_indices) // batch_size) for identity_indices in indices.values())
+        return [[idx for identity_indices in indices.values() for idx in identity_indices[step * batch_size:(step + 1) * batch_size]]
+                for step in range(steps)]
+
+    def train(self):
+        adv_patches_cpu = [utils.get_patch(config) for config in self.configs]
+        optimizers = [optim.Adam([adv_patch_cpu], lr=config.start_learning_rate, amsgrad=True)
+                      for config, adv_patch_cpu in zip(self.configs, adv_patches_cpu)]
+        schedulers = [config.scheduler_factory(optimizer) for config, optimizer in zip(self.configs, optimizers)]
+        scaler = utils.get_grad_scaler(self.config, device)
+        early_stops = [EarlyStopping(current_dir=config.current_dir, patience=config.es_patience, init_patch=adv_patch_cpu)
+                       for config, adv_patch_cpu in zip(self.configs, adv_patches_cpu)]
+        active = list(range(len(self.configs)))
+        for epoch in range(self.config.epochs):
+            epoch_losses = torch.zeros(len(self.configs), 3)
+            epoch_steps = torch.zeros(len(self.configs), dtype=torch.long)
+            loader = DataLoader(self.train_loader.dataset, batch_sampler=self.get_identity_batches(active))
+            progress_bar = tqdm(loader, desc=f'Epoch {epoch}, {len(active)} identities')
+            for img_batch, img_names, cls_id in progress_bar:
+                adv_patch_batch = torch.cat(adv_patches_cpu)[cls_id]
+                (b_loss, sep_loss), vars = self.forward_step(img_batch, adv_patch_batch, cls_id, img_names)
+
+                present = cls_id.unique().tolist()
+                for optimizer in optimizers:
+                    optimizer.zero_grad()
+                scaler.scale(b_loss.sum()).backward()
+                for i in present:
+                    scaler.step(optimizers[i])
+                scaler.update()
+
+                epoch_losses[present] += torch.stack([b_loss] + sep_loss, dim=1).detach().cpu()[present]
+                epoch_steps[present] += 1
+                for i in present:
+                    adv_patches_cpu[i].data.clamp_(0, 1)
+                    self.identities[i].train_losses_iter.append(epoch_losses[i, 0].item() / epoch_steps[i].item())
+                progress_bar.set_postfix_str('train-loss: {:.6}'.format(epoch_losses[present, 0].sum().item() /
+                                                                         epoch_steps[present].sum().item()))
+                del b_loss
+                torch.cuda.empty_cache()
+
+            for i in list(active):
+                identity = self.identities[i]
+                identity.save_losses(epoch_steps[i].item(), *epoch_losses[i].tolist())
+                if early_stops[i](identity.train_losses_epoch[-1], adv_patches_cpu[i], epoch):
+                    active.remove(i)
+                    continue
+                schedulers[i].step(identity.train_losses_epoch[-1])
+            if len(active) == 0:
+                break
+
+        for identity, early_stop in zip(self.identities, early_stops):
+            identity.best_patch = early_stop.best_patch
+            identity.save_final_objects()
+            utils.plot_train_val_loss(identity.config, identity.train_losses_epoch, 'Epoch')
+            utils.plot_train_val_loss(identity.config, identity.train_losses_iter, 'Iterations')
+            utils.plot_separate_loss(identity.config, identity.train_losses_epoch, identity.dist_losses, identity.tv_losses)
+        if self.geometry_cache is not None:
+            print(self.geometry_cache, flush=True)
+
+    def loss_fn(self, patch_embs, tv_loss, cls_id):
+        """
+        Per identity losses, the mean over the images of every identity (zero for identities missing from the batch).
+        """
+        tv_loss = tv_loss.reshape(len(cls_id), -1).sum(dim=1)
+        counts = torch.zeros(len(self.configs), device=device).index_add_(0, cls_id, torch.ones_like(tv_loss)).clamp(min=1)
+        distance = torch.stack([self.dist_loss(patch_emb, self.target_index[emb_name].get_vectors(cls_id))
+                                for emb_name, patch_emb in patch_embs.items()])
+        distance_loss = torch.zeros_like(counts).index_add_(0, cls_id, distance.mean(dim=0)) / counts
+        tv_loss = torch.zeros_like(counts).index_add_(0, cls_id, tv_loss) / counts
+        distance_loss = self.config.dist_weight * distance_loss
+        tv_loss = self.config.tv_weight * tv_loss
+        total_loss = distance_loss + tv_loss
+        return total_loss, [distance_loss, tv_loss]
+
+
 def main():
     mode = 'universal'
     config = patch_config_types[mode]()
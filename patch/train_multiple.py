@@ -1,5 +1,5 @@
 from config import patch_config_types
-from train import AdversarialMask
+from train import AdversarialMask, MultiIdentityAdversarialMask
 from test import Evaluator
 import os
 from shutil import move
@@ -23,7 +23,7 @@ def train_multiple_persons():
         print(f'Starting train person {i+1}...', flush=True)
         adv_mask.train()
         print('Finished train...', flush=True)
-        evaluator = Evaluator(adv_mask)
+        evaluator = Evaluator(config, adv_mask.best_patch)
         print(f'Starting test person {i+1}...', flush=True)
         evaluator.test()
         print('Finished test...', flush=True)
@@ -32,5 +32,33 @@ def train_multiple_persons():
         torch.cuda.empty_cache()
 
 
+def train_multiple_persons_batched():
+    mode = 'targeted'
+    base_config = patch_config_types[mode]()
+    labs = sorted(os.listdir(base_config.train_img_dir)[:100])
+    identities_batch = base_config.train_identities_batch
+    for start in range(0, len(labs), identities_batch):
+        configs = []
+        for lab in labs[start:start + identities_batch]:
+            config = patch_config_types[mode]()
+            config.set_attribute('current_dir', config.current_dir + '_' + lab)
+            config.set_attribute('celeb_lab', [lab])
+            config.set_attribute('celeb_lab_mapper', {0: lab})
+            config.update_test_celeb_lab()
+            configs.append(config)
+        adv_mask = MultiIdentityAdversarialMask(configs)
+        print(f'Starting train persons {start+1}-{start+len(configs)}...', flush=True)
+        adv_mask.train()
+        print('Finished train...', flush=True)
+        for i, identity in enumerate(adv_mask.identities):
+            evaluator = Evaluator(identity.config, identity.best_patch)
+            print(f'Starting test person {start+i+1}...', flush=True)
+            evaluator.test()
+            print('Finished test...', flush=True)
+            del evaluator
+        del adv_mask
+        torch.cuda.empty_cache()
+
+
 if __name__ == '__main__':
-    train_multiple_persons()
+    train_multiple_persons_batched()
@@ -15,6 +15,9 @@ import face_recognition.magface_torch.backbones as MFBackbone
 from landmark_detection.face_alignment.face_alignment import FaceAlignment, LandmarksType
 from landmark_detection.pytorch_face_landmark.models import mobilefacenet
 from config import embedders_dict
+from assets import get_asset
+from frozen import freeze_model
+from model_registry import registry
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 
@@ -80,23 +83,47 @@ class SplitDataset:
         return train_loader, validation_loader, test_loader
 
 
-def load_embedder(embedder_names, device):
+precision_dtypes = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def get_autocast(config, device):
+    """
+    Autocast context of the configured precision, fp32 disables autocast.
+    """
+    dtype = precision_dtypes[config.precision]
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype != torch.float32)
+
+
+def get_grad_scaler(config, device):
+    """
+    Loss scaling is only needed for fp16, bf16 has the exponent range of fp32.
+    """
+    return torch.amp.GradScaler(device.type, enabled=config.precision == 'fp16')
+
+
+def load_embedder(embedder_names, device, frozen=True):
     embedders = {}
     for embedder_name in embedder_names:
-        backbone, head = embedder_name.split('_')
-        weights_path = embedders_dict[backbone]['heads'][head]['weights_path']
-        sd = torch.load(weights_path, map_location=device)
-        if 'magface' in embedder_name:
-            embedder = MFBackbone.IResNet(MFBackbone.IBasicBlock, layers=embedders_dict[backbone]['layers']).to(device).eval()
-            sd = rewrite_weights_dict(sd['state_dict'])
-        else:
-            embedder = InsightFaceResnetBackbone.IResNet(InsightFaceResnetBackbone.IBasicBlock,
-                                                         layers=embedders_dict[backbone]['layers']).to(device).eval()
-        embedder.load_state_dict(sd)
-        embedders[embedder_name] = embedder
+        registry_name = embedder_name if frozen else embedder_name + '_unfrozen'
+        embedders[embedder_name] = registry.get(registry_name, device,
+                                                lambda: build_embedder(embedder_name, device, frozen))
     return embedders
 
 
+def build_embedder(embedder_name, device, frozen=True):
+    backbone, head = embedder_name.split('_')
+    weights_path = embedders_dict[backbone]['heads'][head]['weights_path']
+    if 'magface' in embedder_name:
+        embedder = MFBackbone.IResNet(MFBackbone.IBasicBlock, layers=embedders_dict[backbone]['layers']).to(device).eval()
+        sd = registry.load_state_dict(embedder_name, weights_path, lambda sd: rewrite_weights_dict(sd['state_dict']))
+    else:
+        embedder = InsightFaceResnetBackbone.IResNet(InsightFaceResnetBackbone.IBasicBlock,
+                                                     layers=embedders_dict[backbone]['layers']).to(device).eval()
+        sd = registry.load_state_dict(embedder_name, weights_path)
+    embedder.load_state_dict(sd)
+    return freeze_model(embedder) if frozen else embedder
+
+
 def rewrite_weights_dict(sd):
     sd.pop('fc.weight')
     sd_new = OrderedDict()
@@ -128,7 +155,7 @@ class EarlyStopping:
         self.delta = delta
         self.current_dir = current_dir
         self.best_patch = init_patch
-        self.alpha = transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L'))
+        self.alpha = get_asset('../prnet/new_uv.png')
 
     def __call__(self, val_loss, patch, epoch):
 
@@ -166,12 +193,18 @@ class EarlyStopping:
 
 
 @torch.no_grad()
-def apply_mask(location_extractor, fxz_projector, img_batch, patch_rgb, patch_alpha=None, is_3d=False):
+def apply_mask(location_extractor, fxz_projector, img_batch, patch_rgb, patch_alpha=None, is_3d=False, mask_key=None):
     preds = location_extractor(img_batch)
-    img_batch_applied = fxz_projector(img_batch, preds, patch_rgb, uv_mask_src=patch_alpha, is_3d=is_3d)
+    img_batch_applied = fxz_projector(img_batch, preds, patch_rgb, uv_mask_src=patch_alpha, is_3d=is_3d, mask_key=mask_key)
     return img_batch_applied
 
 
+@torch.no_grad()
+def apply_masks(location_extractor, fxz_projector, img_batch, textures):
+    preds = location_extractor(img_batch)
+    return fxz_projector.project_textures(img_batch, preds, textures)
+
+
 @torch.no_grad()
 def load_mask(config, mask_path, device):
     transform = transforms.Compose([transforms.Resize(config.patch_size), transforms.ToTensor()])
@@ -181,14 +214,21 @@ def load_mask(config, mask_path, device):
 
 
 def get_landmark_detector(config, device):
-    landmark_detector_type = config.landmark_detector_type
+    return registry.get(config.landmark_detector_type, device,
+                        lambda: build_landmark_detector(config.landmark_detector_type, device))
+
+
+def build_landmark_detector(landmark_detector_type, device):
     if landmark_detector_type == 'face_alignment':
-        return FaceAlignment(LandmarksType._2D, device=str(device))
+        face_align = FaceAlignment(LandmarksType._2D, device=str(device))
+        face_align.face_alignment_net = freeze_model(face_align.face_alignment_net, fold_bn=False)
+        return face_align
     elif landmark_detector_type == 'mobilefacenet':
         model = mobilefacenet.MobileFaceNet([112, 112], 136).eval().to(device)
-        sd = torch.load('../landmark_detection/pytorch_face_landmark/weights/mobilefacenet_model_best.pth.tar', map_location=device)['state_dict']
+        sd = registry.load_state_dict('mobilefacenet', '../landmark_detection/pytorch_face_landmark/weights/mobilefacenet_model_best.pth.tar',
+                                      lambda sd: sd['state_dict'])
         model.load_state_dict(sd)
-        return model
+        return freeze_model(model)
 
 
 def get_nested_dataset_files(img_dir, person_labs):
@@ -263,29 +303,52 @@ def get_test_loaders(config, dataset_names):
 
 
 @torch.no_grad()
-def get_person_embedding(config, loader, celeb_lab, location_extractor, fxz_projector, embedders, device, include_others=False):
-    print('Calculating persons embeddings {}...'.format('with mask' if include_others else 'without mask'), flush=True)
-    embeddings_by_embedder = {}
-    for embedder_name, embedder in embedders.items():
-        person_embeddings = {i: torch.empty(0, device=device) for i in range(len(celeb_lab))}
-        masks_path = [config.blue_mask_path, config.black_mask_path, config.white_mask_path]
-        for img_batch, _, person_indices in tqdm(loader):
-            img_batch = img_batch.to(device)
-            if include_others:
+def get_person_embedding(config, loader, celeb_lab, location_extractor, fxz_projector, embedders, device, include_others=False,
+                         embedder_ensemble=None):
+    return get_person_embeddings(config, loader, celeb_lab, location_extractor, fxz_projector, embedders, device,
+                                 include_others=(include_others,), embedder_ensemble=embedder_ensemble)[include_others]
+
+
+@torch.no_grad()
+def get_person_embeddings(config, loader, celeb_lab, location_extractor, fxz_projector, embedders, device,
+                          include_others=(False, True), embedder_ensemble=None):
+    """
+    Per person mean embeddings of every embedder, for every value of include_others (whether the images with a random
+    reference mask are averaged in), in a single pass over the loader. Every batch is masked once and fed to all the
+    embedders, the means are kept as running sums.
+    Returns {include_others: {embedder_name: [persons, 1, emb_size]}}.
+    """
+    print('Calculating persons embeddings {}...'.format(', '.join('with mask' if others else 'without mask' for others in include_others)), flush=True)
+    masks_path = [config.blue_mask_path, config.black_mask_path, config.white_mask_path]
+    masks_t = {mask_path: load_mask(config, mask_path, device) for mask_path in masks_path} if True in include_others else {}
+    sums = {others: {} for others in include_others}
+    counts = {others: torch.zeros(len(celeb_lab), device=device) for others in include_others}
+    for img_batch, _, person_indices in tqdm(loader):
+        img_batch = img_batch.to(device)
+        person_indices = person_indices.to(device)
+        with get_autocast(config, device):
+            if True in include_others:
                 mask_path = masks_path[random.randint(0, 2)]
-                mask_t = load_mask(config, mask_path, device)
-                applied_batch = apply_mask(location_extractor, fxz_projector, img_batch, mask_t[:, :3], mask_t[:, 3], is_3d=True)
+                mask_t = masks_t[mask_path]
+                applied_batch = apply_mask(location_extractor, fxz_projector, img_batch, mask_t[:, :3], mask_t[:, 3], is_3d=True,
+                                           mask_key=mask_path)
                 img_batch = torch.cat([img_batch, applied_batch], dim=0)
-                person_indices = person_indices.repeat(2)
-            embedding = embedder(img_batch)
-            for idx in person_indices.unique():
-                relevant_indices = torch.nonzero(person_indices == idx, as_tuple=True)
-                emb = embedding[relevant_indices]
-                person_embeddings[idx.item()] = torch.cat([person_embeddings[idx.item()], emb], dim=0)
-        final_embeddings = [person_emb.mean(dim=0).unsqueeze(0) for person_emb in person_embeddings.values()]
-        final_embeddings = torch.stack(final_embeddings)
-        embeddings_by_embedder[embedder_name] = final_embeddings
-    return embeddings_by_embedder
+            if embedder_ensemble is not None:
+                embeddings = embedder_ensemble(img_batch)
+            else:
+                embeddings = {embedder_name: embedder(img_batch) for embedder_name, embedder in embedders.items()}
+        for others in include_others:
+            # the clean images come first, the masked ones after them
+            others_indices = person_indices.repeat(2) if others else person_indices
+            counts[others].index_add_(0, others_indices, torch.ones_like(others_indices, dtype=counts[others].dtype))
+            for embedder_name, embedding in embeddings.items():
+                embedding = embedding[:len(others_indices)].type(torch.float32)
+                if embedder_name not in sums[others]:
+                    sums[others][embedder_name] = torch.zeros(len(celeb_lab), embedding.shape[1], device=device)
+                sums[others][embedder_name].index_add_(0, others_indices, embedding)
+    return {others: {embedder_name: (embedder_sums / counts[others][:, None]).unsqueeze(1)
+                     for embedder_name, embedder_sums in sums[others].items()}
+            for others in include_others}
 
 
 def save_class_to_file(config, current_folder):
@@ -302,7 +365,7 @@ def get_patch(config):
         patch = torch.ones((1, 3, config.patch_size[0], config.patch_size[1]), dtype=torch.float32)
     elif config.initial_patch == 'black':
         patch = torch.zeros((1, 3, config.patch_size[0], config.patch_size[1]), dtype=torch.float32) + 0.01
-    uv_face = transforms.ToTensor()(Image.open('../prnet/new_uv.png').convert('L'))
+    uv_face = get_asset('../prnet/new_uv.png')
     patch = patch * uv_face
     patch.requires_grad_(True)
     return patch
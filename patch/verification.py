@@ -0,0 +1,121 @@
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+
+class ScoreHistogram:
+    """
+    Genuine and impostor cosine score counts in num_bins bins over [-1, 1], pairs are streamed in so the number of
+    pairs is not bounded by memory. Bin 0 holds the highest scores.
+    """
+    def __init__(self, num_bins=20000, device='cpu'):
+        self.num_bins = num_bins
+        self.genuine = torch.zeros(num_bins, dtype=torch.float64, device=device)
+        self.impostor = torch.zeros(num_bins, dtype=torch.float64, device=device)
+
+    def get_bins(self, scores):
+        bins = ((scores + 1) / 2 * self.num_bins).type(torch.int64).clamp(0, self.num_bins - 1)
+        return self.num_bins - 1 - bins
+
+    @torch.no_grad()
+    def update(self, scores, is_genuine, valid=None):
+        bins = self.get_bins(scores)
+        if valid is not None:
+            bins, is_genuine = bins[valid], is_genuine[valid]
+        self.genuine += torch.bincount(bins[is_genuine], minlength=self.num_bins)
+        self.impostor += torch.bincount(bins[~is_genuine], minlength=self.num_bins)
+
+    def roc(self):
+        """
+        Returns the false and true accept rates at every bin threshold, in decreasing threshold order.
+        """
+        far = torch.cumsum(self.impostor, dim=0) / self.impostor.sum().clamp(min=1)
+        tar = torch.cumsum(self.genuine, dim=0) / self.genuine.sum().clamp(min=1)
+        return far.cpu(), tar.cpu()
+
+    def tar_at_far(self, far_target):
+        """
+        True accept rate at the lowest threshold whose false accept rate does not exceed far_target.
+        """
+        far, tar = self.roc()
+        below = torch.nonzero(far <= far_target)
+        return tar[below[-1, 0]].item() if len(below) > 0 else 0.
+
+    def __len__(self):
+        return int(self.genuine.sum().item() + self.impostor.sum().item())
+
+
+class VerificationAccumulator:
+    """
+    Collects the clean and masked embeddings of the test images (on the cpu) for 1:1 verification, every masked probe
+    is compared to the clean reference of the other images, either all the pairs or an external pair list.
+    Scores are computed in [block_size, block_size] blocks on device and streamed into a ScoreHistogram per (embedder,
+    mask).
+    """
+    def __init__(self, embedder_names, mask_names):
+        self.embedder_names = embedder_names
+        self.mask_names = mask_names
+        self.embeddings = {(emb_name, mask_name): [] for emb_name in embedder_names for mask_name in mask_names}
+        self.labels = []
+        self.img_names = []
+
+    def update(self, all_embeddings, cls_id, img_names):
+        for emb_name in self.embedder_names:
+            for mask_name, emb in zip(self.mask_names, all_embeddings[emb_name]):
+                self.embeddings[(emb_name, mask_name)].append(F.normalize(emb.type(torch.float32), dim=-1).cpu())
+        self.labels.append(cls_id.to(torch.int64).cpu())
+        self.img_names.extend(img_names)
+
+    def get_embeddings(self, emb_name, mask_name):
+        return torch.cat(self.embeddings[(emb_name, mask_name)])
+
+    @torch.no_grad()
+    def score_all_pairs(self, histogram, references, probes, labels, block_size, device):
+        for i in range(0, len(references), block_size):
+            reference_block = references[i:i + block_size].to(device)
+            reference_labels = labels[i:i + block_size].to(device)
+            for j in range(0, len(probes), block_size):
+                scores = reference_block @ probes[j:j + block_size].to(device).T
+                probe_labels = labels[j:j + block_size].to(device)
+                is_genuine = reference_labels[:, None] == probe_labels[None, :]
+                # an image is not paired with its own masked version
+                valid = (torch.arange(i, i + len(reference_block), device=device)[:, None] !=
+                         torch.arange(j, j + len(probe_labels), device=device)[None, :])
+                histogram.update(scores, is_genuine, valid)
+
+    @torch.no_grad()
+    def score_pair_list(self, histograms, pairs_path, labels, block_size, device):
+        """
+        pairs_path is a csv of image_a, image_b and an optional is_genuine column (otherwise taken from the labels),
+        read in block_size chunks. image_a is the clean reference and image_b the probe.
+        """
+        img_index = {img_name: i for i, img_name in enumerate(self.img_names)}
+        embeddings = {key: self.get_embeddings(*key) for key in histograms.keys()}
+        references = {emb_name: embeddings[(emb_name, self.mask_names[0])] for emb_name in self.embedder_names}
+        for pairs in pd.read_csv(pairs_path, chunksize=block_size):
+            pairs = pairs[pairs.image_a.isin(img_index) & pairs.image_b.isin(img_index)]
+            index_a = torch.tensor(pairs.image_a.map(img_index).values, dtype=torch.int64)
+            index_b = torch.tensor(pairs.image_b.map(img_index).values, dtype=torch.int64)
+            if 'is_genuine' in pairs.columns:
+                is_genuine = torch.tensor(pairs.is_genuine.values.astype(bool), device=device)
+            else:
+                is_genuine = (labels[index_a] == labels[index_b]).to(device)
+            for (emb_name, mask_name), histogram in histograms.items():
+                scores = (references[emb_name][index_a].to(device) * embeddings[(emb_name, mask_name)][index_b].to(device)).sum(dim=1)
+                histogram.update(scores, is_genuine)
+
+    def evaluate(self, block_size=4096, num_bins=20000, pairs_path=None, device='cpu'):
+        """
+        Returns {(emb_name, mask_name): ScoreHistogram}, the references are the clean embeddings (the first mask).
+        """
+        labels = torch.cat(self.labels)
+        histograms = {key: ScoreHistogram(num_bins, device) for key in self.embeddings.keys()}
+        if pairs_path is not None:
+            self.score_pair_list(histograms, pairs_path, labels, block_size, device)
+            return histograms
+        for emb_name in self.embedder_names:
+            references = self.get_embeddings(emb_name, self.mask_names[0])
+            for mask_name in self.mask_names:
+                self.score_all_pairs(histograms[(emb_name, mask_name)], references,
+                                     self.get_embeddings(emb_name, mask_name), labels, block_size, device)
+        return histograms